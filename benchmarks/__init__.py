@@ -0,0 +1 @@
+""" Замеры производительности бота. Запускаются из корня проекта: python -m benchmarks.<имя_модуля>"""
@@ -0,0 +1,59 @@
+""" Время импорта модулей бота и проверка, что импорт обходится без побочных эффектов.
+
+    Каждый модуль импортируется в отдельном чистом процессе REPEATS раз. Сеть и input() в этих процессах
+    запрещены: если импорт попробует авторизоваться в ВК, подключиться к БД или спросить логин, замер упадёт.
+    Превышение бюджета (VKINDER_IMPORT_BUDGET, секунды на медиану) - ненулевой код выхода,
+    так что замер годится как проверка от регрессий.
+    python -m benchmarks.bench_import"""
+
+import os
+import statistics
+import subprocess
+import sys
+
+MODULES = ('config', 'database', 'vk_scope', 'bot')
+REPEATS = 5
+BUDGET = float(os.getenv('VKINDER_IMPORT_BUDGET', 1.0))
+
+# код, выполняемый в дочернем процессе: запрет побочных эффектов и замер одного импорта
+PROBE = '''
+import builtins, importlib, socket, sys, time
+
+def forbidden(*args, **kwargs):
+    raise RuntimeError('побочный эффект при импорте')
+
+socket.socket.connect = forbidden
+socket.create_connection = forbidden
+builtins.input = forbidden
+
+started = time.perf_counter()
+importlib.import_module(sys.argv[1])
+print(time.perf_counter() - started)
+'''
+
+
+def measure(module: str) -> float:
+    """Медиана времени импорта модуля в чистом процессе"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    timings = []
+    for _ in range(REPEATS):
+        result = subprocess.run([sys.executable, '-c', PROBE, module], cwd=root, capture_output=True, text=True)
+        if result.returncode:
+            raise RuntimeError(f'импорт {module} не удался:\n{result.stderr}')
+        timings.append(float(result.stdout.strip().splitlines()[-1]))
+    return statistics.median(timings)
+
+
+if __name__ == '__main__':
+    failed = False
+    for module in MODULES:
+        try:
+            elapsed = measure(module)
+        except RuntimeError as error:
+            print(error)
+            failed = True
+            continue
+        over = elapsed > BUDGET
+        failed = failed or over
+        print(f'{module:>10}: {elapsed * 1000:7.1f} мс{"  - больше бюджета" if over else ""}')
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,88 @@
+""" Задержка горячих запросов к query и datinguser до и после индексов из migrations.py.
+
+    Замер идёт на отдельной базе (VKINDER_BENCH_DB): в неё генерируется DATINGUSERS строк datinguser,
+    затем каждый запрос выполняется до и после миграции с индексами.
+    python -m benchmarks.bench_indexes [DATINGUSERS]"""
+
+import random
+import statistics
+import sys
+import time
+
+from sqlalchemy import text
+
+import migrations
+from benchmarks.bench_fixtures import BENCH_DB
+from config import config
+from database import Base, Connect
+
+USERS = 10000
+QUERIES = 200000
+REPEATS = 50
+
+HOT_QUERIES = {
+    'непросмотренные результаты запроса':
+        'SELECT id, vk_id, first_name, last_name, link FROM datinguser '
+        'WHERE query_id = :query_id AND viewed IS FALSE',
+    'юзер в запросе':
+        'SELECT viewed FROM datinguser WHERE vk_id = :vk_id AND query_id = :query_id',
+    'чёрный список пользователя':
+        'SELECT d.id, d.vk_id FROM datinguser d JOIN query q ON q.id = d.query_id '
+        'WHERE q.user_id = :user_id AND d.black_list IS TRUE',
+    'последний запрос пользователя':
+        'SELECT id FROM query WHERE user_id = :user_id ORDER BY datetime DESC LIMIT 1',
+}
+
+
+def seed(conn, datingusers: int) -> None:
+    """Генерация пользователей, запросов и результатов поиска средствами самой БД"""
+    print(f'Генерируем {datingusers} строк datinguser...')
+    conn.execute(text('TRUNCATE datinguser, query, "user" CASCADE'))
+    conn.execute(text('INSERT INTO "user" (id, first_name) SELECT g, \'user\' || g FROM generate_series(1, :n) g'),
+                 n=USERS)
+    conn.execute(text('INSERT INTO query (id, datetime, user_id) '
+                      'SELECT g, now() - g * interval \'1 minute\', 1 + (random() * (:users - 1))::int '
+                      'FROM generate_series(1, :n) g'), users=USERS, n=QUERIES)
+    conn.execute(text('INSERT INTO datinguser (vk_id, first_name, last_name, link, query_id, viewed, black_list) '
+                      'SELECT (random() * 100000000)::int, \'Имя\', \'Фамилия\', \'https://vk.com/id\' || g, '
+                      '1 + (random() * (:queries - 1))::int, random() < 0.7, '
+                      'CASE WHEN random() < 0.5 THEN NULL ELSE random() < 0.3 END '
+                      'FROM generate_series(1, :n) g'), queries=QUERIES, n=datingusers)
+    conn.execute(text('ANALYZE'))
+
+
+def measure(conn) -> dict:
+    results = {}
+    for name, sql in HOT_QUERIES.items():
+        timings = []
+        for _ in range(REPEATS):
+            params = {'query_id': random.randint(1, QUERIES), 'user_id': random.randint(1, USERS),
+                      'vk_id': random.randint(1, 100000000)}
+            started = time.perf_counter()
+            conn.execute(text(sql), **params).fetchall()
+            timings.append((time.perf_counter() - started) * 1000)
+        results[name] = statistics.median(timings)
+    return results
+
+
+if __name__ == '__main__':
+    datingusers = int(sys.argv[1]) if len(sys.argv) > 1 else 5000000
+    config.db_url = BENCH_DB
+    engine = Connect.engine
+    Base.metadata.create_all(engine)
+    # create_all уже создал индексы из моделей - приводим базу к состоянию "до"
+    migrations.upgrade(engine)
+    migrations.downgrade(engine, to=1)
+    with engine.begin() as conn:
+        seed(conn, datingusers)
+    with engine.connect() as conn:
+        before = measure(conn)
+    migrations.upgrade(engine)
+    with engine.begin() as conn:
+        conn.execute(text('ANALYZE'))
+    with engine.connect() as conn:
+        after = measure(conn)
+
+    print(f'{"запрос":<40}{"до, мс":>12}{"после, мс":>12}')
+    for name in HOT_QUERIES:
+        print(f'{name:<40}{before[name]:>12.2f}{after[name]:>12.2f}')
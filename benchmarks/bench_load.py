@@ -0,0 +1,263 @@
+""" Нагрузочный прогон настоящего Bot синтетическими диалогами.
+
+    События приходят не из VkLongPoll, а из локальной ленты FakeLongPoll, API ВК заменяет FakeVK,
+    БД - тестовая база VKINDER_BENCH_DB. N пользователей одновременно проходят сценарий
+    "Привет" -> детализированный опросник -> просмотр кандидатов с ответами "Да"/"Нет" -> "Отмена",
+    делая паузы между сообщениями. Для каждого шага записывается время до ответа бота.
+    Шаг без единого ответа за --timeout считается потерянным, шаг, на который пришёл не тот ответ, -
+    ушедшим не в тот диалог (туда же - сообщения незнакомым получателям).
+    Для каждого N печатаются задержки по шагам и точка кривой нагрузки: перцентили времени ответа,
+    шагов в секунду, потери и число вызовов API и запросов к БД на один диалог.
+    python -m benchmarks.bench_load [--users 1 5 10 25 50 100] [--csv curve.csv]"""
+
+import argparse
+import csv
+import os
+import queue
+import random
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Dict, Any, List, Tuple
+
+from sqlalchemy import event
+from vk_api.longpoll import VkEventType
+
+import migrations
+from benchmarks.bench_fixtures import BENCH_DB
+from benchmarks.bench_paths import percentile, write_fixtures
+from benchmarks.fake_vk import FakeVK, redirect
+from bot import Bot
+from config import config
+from database import Base, Connect, reference_data
+from vk_scheduler import ScheduledVkApi
+from vk_scope import VKAuth
+
+# шаг сценария: название, текст пользователя, кусок ответа бота, по которому видно, что шаг обработан
+STEP = Tuple[str, str, str]
+
+
+class FakeLongPoll:
+    """Лента событий вместо VkLongPoll: check() отдаёт все накопившиеся события или ждёт первое до wait секунд"""
+
+    def __init__(self, wait: float = 0.5):
+        self.queue = queue.Queue()
+        self.wait = wait
+
+    def push(self, user_id: int, text: str) -> None:
+        self.queue.put(SimpleNamespace(type=VkEventType.MESSAGE_NEW, to_me=True, user_id=user_id, text=text))
+
+    def check(self) -> List[SimpleNamespace]:
+        try:
+            events = [self.queue.get(timeout=self.wait)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                events.append(self.queue.get_nowait())
+            except queue.Empty:
+                return events
+
+
+class Replies:
+    """Сообщения бота, дошедшие до FakeVK, по получателям"""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.messages: Dict[int, List[Tuple[float, str]]] = defaultdict(list)
+        self.recipients = Counter()
+
+    def add(self, user_id: int, text: str) -> None:
+        with self.cond:
+            self.messages[user_id].append((time.perf_counter(), text))
+            self.recipients[user_id] += 1
+            self.cond.notify_all()
+
+    def wait_for(self, user_id: int, marker: str, deadline: float) -> Tuple[float or None, bool]:
+        """Ожидание сообщения с marker до deadline. Возвращает время его прихода (или None)
+        и признак того, что пользователю вообще что-то пришло"""
+        with self.cond:
+            while True:
+                messages = self.messages[user_id]
+                for number, (arrived, text) in enumerate(messages):
+                    if marker in text:
+                        del messages[:number + 1]
+                        return arrived, True
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    got_any = bool(messages)
+                    messages.clear()
+                    return None, got_any
+                self.cond.wait(remaining)
+
+
+class RecordingVK(FakeVK):
+    """FakeVK, передающий отправленные ботом сообщения в Replies"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.replies = Replies()
+
+    def messages_send(self, values: Dict[str, Any]) -> int:
+        self.replies.add(int(values['user_id']), values.get('message', ''))
+        return super().messages_send(values)
+
+
+def scenario(ratings: int) -> List[STEP]:
+    """Сценарий одного пользователя: полный опросник и ratings оценок кандидатов"""
+    statuses = reference_data.status_titles()
+    sorts = reference_data.sort_titles()
+    steps = [
+        ('привет', 'Привет', 'Хочешь найти'),
+        ('подтверждение', 'Да', 'Какой вид поиска'),
+        ('вид поиска', 'детализированный', 'В каком городе'),
+        ('город', 'Москва', 'минимальный возраст'),
+        ('возраст от', '25', 'максимальный возраст'),
+        ('возраст до', '35', 'Какой из статусов'),
+        ('статус', statuses[min(5, len(statuses) - 1)], 'Как отсортировать'),
+        ('поиск', sorts[0], 'Нравится?'),
+    ]
+    steps += [('оценка', random.choice(('Да', 'Нет')), 'Нравится?') for _ in range(ratings)]
+    steps.append(('отмена', 'Отмена', 'Заходи ещё'))
+    return steps
+
+
+def simulate(user_id: int, steps: List[STEP], feed: FakeLongPoll, replies: Replies, think: float,
+             timeout: float) -> Dict[str, Any]:
+    """Один пользователь, проходящий сценарий. После потерянного или чужого ответа диалог прекращается"""
+    result = {'timings': defaultdict(list), 'dropped': 0, 'misrouted': 0}
+    for step, text, marker in steps:
+        time.sleep(random.uniform(0, 2 * think))
+        started = time.perf_counter()
+        feed.push(user_id, text)
+        arrived, got_any = replies.wait_for(user_id, marker, started + timeout)
+        if arrived is None:
+            result['misrouted' if got_any else 'dropped'] += 1
+            break
+        result['timings'][step].append(arrived - started)
+    return result
+
+
+def run_level(fake: RecordingVK, users: int, first_id: int, args) -> Dict[str, Any]:
+    """Прогон N одновременных диалогов на свежем экземпляре бота"""
+    bot = Bot()
+    redirect(bot.vk_bot, fake.url)
+    feed = FakeLongPoll()
+    bot.longpoll = feed
+    fake.replies = replies = Replies()
+    fake.calls.clear()
+    statements = Counter()
+
+    def count_statement(*_):
+        statements['sql'] += 1
+
+    event.listen(Connect.engine, 'before_cursor_execute', count_statement)
+    stop = threading.Event()
+
+    def dispatch():
+        while not stop.is_set():
+            bot.dispatch_many(bot.longpoll.check())
+
+    dispatcher = threading.Thread(target=dispatch, name='load-dispatcher', daemon=True)
+    dispatcher.start()
+
+    user_ids = range(first_id, first_id + users)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users, thread_name_prefix='load-user') as executor:
+        results = list(executor.map(lambda user_id: simulate(user_id, scenario(args.ratings), feed, replies,
+                                                             args.think, args.timeout), user_ids))
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    dispatcher.join()
+    event.remove(Connect.engine, 'before_cursor_execute', count_statement)
+    bot.search_pool.shutdown(cancel_futures=True)
+
+    timings = defaultdict(list)
+    for result in results:
+        for step, values in result['timings'].items():
+            timings[step].extend(values)
+    strangers = sum(count for user_id, count in replies.recipients.items() if user_id not in user_ids)
+    return {
+        'users': users,
+        'timings': timings,
+        'all': [value for values in timings.values() for value in values],
+        'elapsed': elapsed,
+        'dropped': sum(result['dropped'] for result in results),
+        'misrouted': sum(result['misrouted'] for result in results) + strangers,
+        'api': sum(fake.calls.values()) / users,
+        'sql': statements['sql'] / users,
+    }
+
+
+def prepare(fake: FakeVK) -> None:
+    """Схема и справочники тестовой базы - те же, что в benchmarks.bench_paths"""
+    fixtures = tempfile.mkdtemp(prefix='vkinder-fixtures-')
+
+    class FixtureConnect(Connect):
+        FIXTURES = fixtures + os.sep
+
+    try:
+        write_fixtures(fixtures, fake)
+        Base.metadata.create_all(Connect.engine)
+        migrations.upgrade(Connect.engine)
+        FixtureConnect()._insert_basics(engine='copy')
+    finally:
+        shutil.rmtree(fixtures)
+
+
+def main(args) -> None:
+    # до первого обращения к Connect.engine: движок создастся уже на тестовой базе
+    config.db_url = BENCH_DB
+
+    fake = RecordingVK(latency=args.latency, jitter=args.jitter, countries=args.countries).start()
+    VKAuth.vk_session = redirect(ScheduledVkApi(token='load', rate=args.rate), fake.url)
+    curve = []
+    try:
+        prepare(fake)
+        # у каждого прогона свои пользователи: новые диалоги, а не продолжение старых
+        first_id = 100000000 + int(time.time()) % 1000 * 100000
+        for number, users in enumerate(args.users):
+            level = run_level(fake, users, first_id + number * 10000, args)
+            curve.append(level)
+            print(f'\n{users} пользователей, {level["elapsed"]:.1f} с')
+            for step, values in level['timings'].items():
+                print(f'  {step:<16}{percentile(values, 50) * 1000:>9.0f}{percentile(values, 95) * 1000:>9.0f} мс')
+    finally:
+        fake.stop()
+
+    columns = ('users', 'p50_ms', 'p95_ms', 'p99_ms', 'steps_per_s', 'dropped', 'misrouted', 'api_per_dialog',
+               'sql_per_dialog')
+    rows = [(level['users'],
+             *(round(percentile(level['all'], q) * 1000, 1) if level['all'] else None for q in (50, 95, 99)),
+             round(len(level['all']) / level['elapsed'], 1), level['dropped'], level['misrouted'],
+             round(level['api'], 1), round(level['sql'], 1)) for level in curve]
+
+    print('\n' + ''.join(f'{column:>15}' for column in columns))
+    for row in rows:
+        print(''.join(f'{"-" if value is None else value:>15}' for value in row))
+    if args.csv:
+        with open(args.csv, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, nargs='+', default=[1, 5, 10, 25, 50, 100],
+                        help='число одновременных диалогов для каждой точки кривой')
+    parser.add_argument('--ratings', type=int, default=10, help='оценок кандидатов в каждом диалоге')
+    parser.add_argument('--think', type=float, default=1.0, help='средняя пауза пользователя между сообщениями, с')
+    parser.add_argument('--timeout', type=float, default=30.0, help='сколько ждать ответа бота на шаг, с')
+    parser.add_argument('--latency', type=float, default=0.05, help='задержка ответа API, с')
+    parser.add_argument('--jitter', type=float, default=0.02, help='случайная добавка к задержке, с')
+    parser.add_argument('--rate', type=float, default=3,
+                        help='лимит запросов в секунду для токена пользователя (3 - как у настоящего)')
+    parser.add_argument('--countries', type=int, default=20, help='стран в гео-данных FakeVK')
+    parser.add_argument('--csv', help='файл для кривой нагрузки, чтобы сравнивать её между релизами')
+    main(parser.parse_args())
@@ -0,0 +1,206 @@
+""" Задержка и пропускная способность горячих путей бота на одной машине, без сети.
+
+    API ВК заменяет локальный FakeVK (задержка ответа - --latency), БД - отдельная база VKINDER_BENCH_DB.
+    В неё загружаются сгенерированные справочники и гео-фикстуры (тем же _insert_basics, что и в бою)
+    и генерируется --datingusers строк datinguser. Замеряются:
+    - _insert_basics обоими способами загрузки,
+    - _get_city (поиск города и региона в API),
+    - search_users (первая страница поиска с записью в БД),
+    - show_results (от начала показа до первого кандидата с фото),
+    - полный обход гео-данных VKGeoCrawler.
+    Для каждого пути печатаются перцентили задержки и пропускная способность.
+    python -m benchmarks.bench_paths [--latency 0.05] [--repeats 50] [--datingusers 1000000]"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from typing import List, Callable, Any
+
+import migrations
+from benchmarks.bench_fixtures import BENCH_DB
+from benchmarks.bench_indexes import seed, USERS
+from benchmarks.fake_vk import FakeVK, redirect
+from bot import Bot
+from cache import TTLCache
+from config import config
+from database import Base, Connect
+from dialog import Dialog
+from vk_scheduler import ScheduledVkApi
+from vk_scope import VKAuth, VKGeoData, VKGeoCrawler, VKUser
+
+PRIMARY_DATA = {
+    'sex': ['любой', 'женский', 'мужской'],
+    'status': ['не указано', 'не женат (не замужем)', 'встречается', 'помолвлен(-а)', 'женат (замужем)',
+               'всё сложно', 'в активном поиске', 'влюблён(-а)', 'в гражданском браке'],
+    'sort': ['по популярности', 'по дате регистрации'],
+}
+
+
+def percentile(timings: List[float], q: int) -> float:
+    if len(timings) == 1:
+        return timings[0]
+    return statistics.quantiles(timings, n=100, method='inclusive')[q - 1]
+
+
+def report(name: str, timings: List[float], units: int = None, unit: str = 'оп') -> None:
+    """Строка отчёта: p50/p95/p99 в миллисекундах и units (по умолчанию - число замеров) в секунду"""
+    units = len(timings) if units is None else units
+    print(f'{name:<28}{percentile(timings, 50) * 1000:>10.1f}{percentile(timings, 95) * 1000:>10.1f}'
+          f'{percentile(timings, 99) * 1000:>10.1f}{units / sum(timings):>12.1f} {unit}/с')
+
+
+def measure(func: Callable[[int], Any], repeats: int, setup: Callable[[int], Any] = None) -> List[float]:
+    """Время repeats вызовов func(i); setup(i) выполняется перед каждым вызовом и в замер не входит"""
+    timings = []
+    for i in range(repeats):
+        if setup:
+            setup(i)
+        started = time.perf_counter()
+        func(i)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def write_fixtures(path: str, fake: FakeVK) -> int:
+    """Фикстуры для _insert_basics с теми же гео-данными, что отдаёт FakeVK. Возвращает число строк"""
+    with open(os.path.join(path, 'primary_data.json'), 'w', encoding='utf-8') as f:
+        json.dump([{'model': model, 'fields': {'id': number, 'title': title}}
+                   for model, titles in PRIMARY_DATA.items() for number, title in enumerate(titles)], f)
+    rows = sum(len(titles) for titles in PRIMARY_DATA.values())
+
+    countries = fake.get_countries({'count': 10 ** 6})['items']
+    regions = list(VKGeoData.SEED_REGIONS)
+    for country in countries:
+        regions.extend({'model': 'region', 'fields': {**region, 'country_id': country['id']}}
+                       for region in fake.get_regions({'country_id': country['id'], 'count': 10 ** 6})['items'])
+    cities = ({'model': 'city', 'fields': {**city, 'region_id': region['fields']['id']}} for region in regions
+              for city in fake.get_cities({'region_id': region['fields']['id'], 'count': 10 ** 6})['items'])
+    fixtures = {'countries': ({'model': 'country', 'fields': country} for country in countries),
+                'regions': iter(regions),
+                'cities': cities}
+    for name, objects in fixtures.items():
+        with open(os.path.join(path, name + '.jsonl'), 'w', encoding='utf-8') as f:
+            for obj in objects:
+                f.write(json.dumps(obj, ensure_ascii=False) + '\n')
+                rows += 1
+    return rows
+
+
+def bench_insert_basics(fixtures: str, rows: int, repeats: int) -> None:
+    class FixtureConnect(Connect):
+        FIXTURES = fixtures
+
+    connect = FixtureConnect()
+
+    def truncate(_):
+        with connect.unit_of_work() as session:
+            session.execute('TRUNCATE city, region, country, sex, status, sort CASCADE')
+
+    for engine in ('insert', 'copy'):
+        timings = measure(lambda _: connect._insert_basics(engine=engine), repeats, setup=truncate)
+        report(f'_insert_basics ({engine})', timings, rows * repeats, 'строк')
+
+
+def bench_bot(fake: FakeVK, repeats: int) -> None:
+    bot = Bot()
+    redirect(bot.vk_bot, fake.url)
+    users = {}
+
+    def vk_user(i: int) -> VKUser:
+        user_id = 1 + i % USERS
+        if user_id not in users:
+            users[user_id] = VKUser(user_id, fake.users_get({'user_id': user_id})[0])
+        return users[user_id]
+
+    timings = measure(lambda i: bot._get_city(1, f'Город {i}'), repeats)
+    report('_get_city', timings)
+
+    # каждый поиск - мимо общего кэша страниц, чтобы мерить сам поиск, а не кэш
+    streams = []
+
+    def search(i):
+        with bot.unit_of_work():
+            stream = bot.search_users(vk_user(i), {'age_from': 18 + i % 40, 'age_to': 28 + i % 40,
+                                                   'status': 1 + i % 8})
+        stream.cancel()
+        streams.append(stream)
+
+    timings = measure(search, repeats,
+                      setup=lambda _: setattr(bot, 'search_cache', TTLCache(bot.SEARCH_CACHE_SIZE,
+                                                                            bot.SEARCH_CACHE_TTL)))
+    report('search_users', timings)
+
+    dialogs = []
+
+    def show(i):
+        stream = streams[i % len(streams)]
+        dialog = Dialog(stream.vk_user)
+        dialogs.append(dialog)
+        with bot.unit_of_work():
+            bot.show_results(dialog, bot.get_datingusers_from_db(stream.vk_user.user_id, query_id=stream.query_id),
+                             stream.total)
+
+    timings = measure(show, repeats)
+    report('show_results', timings)
+    for dialog in dialogs:
+        dialog.reset()
+
+
+def bench_crawl(repeats: int) -> None:
+    crawl_dir = tempfile.mkdtemp(prefix='vkinder-crawl-')
+
+    class BenchCrawler(VKGeoCrawler):
+        FIXTURES = crawl_dir + os.sep
+
+    def clean(_):
+        for name in os.listdir(crawl_dir):
+            os.remove(os.path.join(crawl_dir, name))
+
+    try:
+        timings = measure(lambda _: BenchCrawler().crawl_cities(), repeats, setup=clean)
+        with open(os.path.join(crawl_dir, 'cities.jsonl'), encoding='utf-8') as f:
+            rows = sum(1 for _ in f)
+        report('VKGeoCrawler.crawl_cities', timings, rows * repeats, 'городов')
+    finally:
+        shutil.rmtree(crawl_dir)
+
+
+def main(args) -> None:
+    # до первого обращения к Connect.engine: движок создастся уже на тестовой базе
+    config.db_url = BENCH_DB
+
+    fake = FakeVK(latency=args.latency, jitter=args.jitter, countries=args.countries).start()
+    VKAuth.vk_session = redirect(ScheduledVkApi(token='bench', rate=args.rate), fake.url)
+    fixtures = tempfile.mkdtemp(prefix='vkinder-fixtures-')
+    try:
+        rows = write_fixtures(fixtures, fake)
+        Base.metadata.create_all(Connect.engine)
+        migrations.upgrade(Connect.engine)
+
+        print(f'{"путь":<28}{"p50, мс":>10}{"p95, мс":>10}{"p99, мс":>10}{"пропускная способность":>24}')
+        bench_insert_basics(fixtures + os.sep, rows, args.load_repeats)
+        with Connect.engine.begin() as conn:
+            seed(conn, args.datingusers)
+        bench_bot(fake, args.repeats)
+        bench_crawl(args.load_repeats)
+        print(f'вызовы API: {dict(fake.calls)}')
+    finally:
+        fake.stop()
+        shutil.rmtree(fixtures)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--latency', type=float, default=0.05, help='задержка ответа API, с')
+    parser.add_argument('--jitter', type=float, default=0.02, help='случайная добавка к задержке, с')
+    parser.add_argument('--rate', type=float, default=1000,
+                        help='лимит запросов в секунду для токена (3 - как у настоящего пользователя)')
+    parser.add_argument('--repeats', type=int, default=50, help='замеров на каждый путь бота')
+    parser.add_argument('--load-repeats', type=int, default=3, help='замеров загрузки фикстур и обхода гео-данных')
+    parser.add_argument('--countries', type=int, default=20, help='стран в гео-данных FakeVK')
+    parser.add_argument('--datingusers', type=int, default=1000000, help='строк datinguser в тестовой базе')
+    main(parser.parse_args())
@@ -0,0 +1,226 @@
+""" Локальная замена API ВК для замеров без сети.
+
+    FakeVK - HTTP-сервер, отвечающий на /method/<метод> так же, как api.vk.com, но заготовленными данными:
+    users.search, users.get, photos.get, database.getCountries/getRegions/getCities, messages.send и execute.
+    Ответы детерминированы (одинаковый запрос - одинаковый ответ), задержка ответа настраивается.
+    redirect(vk_session, url) направляет запросы сессии vk_api на этот сервер вместо api.vk.*."""
+
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Any, List, Tuple
+from urllib.parse import parse_qsl, urlsplit, urlunsplit
+
+from requests.adapters import HTTPAdapter
+
+# адрес API зависит от версии vk_api (api.vk.com, api.vk.ru) - подменяется любой api.vk.*
+VK_API = re.compile(r'api\.vk\.[a-z]+')
+
+# города федерального значения: ВК отдаёт их отдельно от остальных регионов (см. VKGeoData.SEED_REGIONS)
+SEED_CITIES = {1: {'id': 1, 'title': 'Москва', 'important': 1},
+               2: {'id': 2, 'title': 'Санкт-Петербург', 'important': 1}}
+
+
+class _Redirect(HTTPAdapter):
+    """ Транспорт requests, отправляющий запросы к api.vk.* на другой адрес.
+    Запрос на любой другой адрес - ошибка: замер не должен уходить в сеть."""
+
+    def __init__(self, url: str):
+        super().__init__()
+        self.target = urlsplit(url)
+
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        if not VK_API.fullmatch(parts.hostname or ''):
+            raise RuntimeError(f'Запрос мимо подменённого API ВК: {request.url}')
+        request.url = urlunsplit(parts._replace(scheme=self.target.scheme, netloc=self.target.netloc))
+        return super().send(request, **kwargs)
+
+
+def redirect(vk_session, url: str):
+    """Все запросы сессии vk_api уходят на url вместо api.vk.*, любые другие запрещены"""
+    adapter = _Redirect(url)
+    vk_session.http.mount('https://', adapter)
+    vk_session.http.mount('http://', adapter)
+    return vk_session
+
+
+class FakeVK:
+    """ Сервер с заготовленными ответами API ВК.
+    latency (+ случайная добавка до jitter) - задержка каждого ответа в секундах,
+    per_age - сколько человек users.search находит на каждый год возраста."""
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.0, countries: int = 20, regions: int = 30,
+                 cities: int = 200, per_age: int = 150, photos: int = 5):
+        self.latency = latency
+        self.jitter = jitter
+        self.countries = countries
+        self.regions = regions
+        self.cities = cities
+        self.per_age = per_age
+        self.photos = photos
+        self.calls = Counter()
+        self.message_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.server = None
+        self.handlers = {
+            'users.search': self.users_search,
+            'users.get': self.users_get,
+            'photos.get': self.photos_get,
+            'database.getCountries': self.get_countries,
+            'database.getRegions': self.get_regions,
+            'database.getCities': self.get_cities,
+            'messages.send': self.messages_send,
+            'execute': self.execute,
+        }
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    def start(self) -> 'FakeVK':
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                values = dict(parse_qsl(self.rfile.read(length).decode('utf-8')))
+                self._reply(values)
+
+            def do_GET(self):
+                self._reply(dict(parse_qsl(self.path.partition('?')[2])))
+
+            def _reply(self, values: Dict[str, str]) -> None:
+                method = self.path.partition('?')[0].rsplit('/', 1)[-1]
+                body = json.dumps(fake.handle(method, values), ensure_ascii=False).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='fake-vk', daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, method: str, values: Dict[str, Any]) -> Dict[str, Any]:
+        """Ответ на один HTTP-запрос к API"""
+        with self.lock:
+            self.calls[method] += 1
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+        try:
+            return {'response': self.call(method, values)}
+        except KeyError:
+            return {'error': {'error_code': 3, 'error_msg': f'Unknown method passed: {method}'}}
+
+    def call(self, method: str, values: Dict[str, Any]) -> Any:
+        return self.handlers[method](values)
+
+    """Заготовленные методы"""
+
+    @staticmethod
+    def _page(items: List[Any], values: Dict[str, Any], count: int = 100) -> Dict[str, Any]:
+        offset = int(values.get('offset', 0))
+        count = int(values.get('count', count))
+        return {'count': len(items), 'items': items[offset:offset + count]}
+
+    def get_countries(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        countries = [{'id': 1, 'title': 'Россия'}]
+        countries += [{'id': country_id, 'title': f'Страна {country_id}'} for country_id in
+                      range(2, self.countries + 1)]
+        return self._page(countries, values)
+
+    def get_regions(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        if values.get('q'):
+            # поиск региона по названию (Bot._get_region) - находим ровно его
+            return {'count': 1, 'items': [{'id': 900000 + len(values['q']), 'title': values['q'] + ' область'}]}
+        country_id = int(values['country_id'])
+        regions = [{'id': country_id * 1000 + number, 'title': f'Регион {country_id}-{number}'}
+                   for number in range(1, self.regions + 1)]
+        return self._page(regions, values)
+
+    def get_cities(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        if values.get('q'):
+            # поиск города по названию (Bot._get_city)
+            city = {'id': 90000000 + len(values['q']), 'title': values['q'], 'area': None,
+                    'region': values['q'] + ' область', 'important': 0}
+            return {'count': 1, 'items': [city]}
+        region_id = int(values['region_id'])
+        if region_id in SEED_CITIES:
+            return self._page([SEED_CITIES[region_id]], values)
+        cities = [{'id': region_id * 1000 + number, 'title': f'Город {region_id}-{number}', 'area': None,
+                   'region': f'Регион {region_id}', 'important': 0} for number in range(1, self.cities + 1)]
+        return self._page(cities, values)
+
+    def users_search(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        """Найденные юзеры зависят только от условий поиска: одинаковый год возраста - одни и те же люди"""
+        age_from, age_to = int(values.get('age_from', 18)), int(values.get('age_to', 80))
+        month = int(values.get('birth_month', 0))
+        ages = range(age_from, age_to + 1)
+        per_age = self.per_age // 12 if month else self.per_age
+        seed = zlib.crc32(repr((values.get('city'), values.get('sex'), values.get('status'))).encode()) % 100
+        total = per_age * len(ages)
+        count = min(int(values.get('count', 20)), total, 1000)
+        items = []
+        for number in range(count):
+            age = ages[number % len(ages)]
+            vk_id = ((seed * 100 + age) * 13 + month) * 10000 + number // len(ages)
+            items.append({'id': vk_id, 'first_name': f'Имя{vk_id}', 'last_name': f'Фамилия{vk_id}',
+                          'domain': f'id{vk_id}', 'verified': 0, 'is_closed': 0, 'can_access_closed': True})
+        return {'count': total, 'items': items}
+
+    def users_get(self, values: Dict[str, Any]) -> List[Dict[str, Any]]:
+        ids = str(values.get('user_ids') or values.get('user_id')).split(',')
+        return [{'id': int(user_id), 'first_name': f'Пользователь{user_id}', 'last_name': 'Тестовый',
+                 'sex': 1 + int(user_id) % 2, 'domain': f'id{user_id}',
+                 'city': {'id': 1, 'title': 'Москва'}, 'country': {'id': 1, 'title': 'Россия'}}
+                for user_id in ids]
+
+    def photos_get(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        owner_id = int(values['owner_id'])
+        photos = [{'id': owner_id * 10 + number, 'owner_id': owner_id, 'likes': {'count': (owner_id + number) % 97}}
+                  for number in range(self.photos)]
+        return {'count': len(photos), 'items': photos}
+
+    def messages_send(self, values: Dict[str, Any]) -> int:
+        return next(self.message_ids)
+
+    def execute(self, values: Dict[str, Any]) -> List[Any]:
+        """Выполнение кода из vk_batch.execute_code: return [API.метод({...}), ...];"""
+        results = []
+        for method, call_values in parse_execute(values['code']):
+            with self.lock:
+                self.calls[method] += 1
+            try:
+                results.append(self.call(method, call_values))
+            except KeyError:
+                results.append(False)
+        return results
+
+
+def parse_execute(code: str) -> List[Tuple[str, Dict[str, Any]]]:
+    """Вызовы API из кода VKScript, собранного vk_batch.execute_code"""
+    decoder = json.JSONDecoder()
+    calls = []
+    pos = code.find('API.')
+    while pos != -1:
+        bracket = code.index('(', pos)
+        values, end = decoder.raw_decode(code, bracket + 1)
+        calls.append((code[pos + 4:bracket], values))
+        pos = code.find('API.', end)
+    return calls
@@ -6,39 +6,113 @@
 
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import cached_property
 from random import randrange
-from typing import Dict, Any, Tuple, List
+from typing import Dict, Any, Tuple, List, Iterator
 
-import vk_api
 from vk_api.keyboard import VkKeyboard, VkKeyboardColor
 from vk_api.longpoll import VkLongPoll, VkEventType
 
-from database import User, City, Status, Sex, Sort, Query, DatingUser, Country, Region, Connect
-from vk_scope import VKUser, VKDatingUser, VKAuth
-
+import tracing
+from cache import TTLCache
+from callback import CallbackReceiver
+from config import config
+from database import User, City, Query, DatingUser, Region, Connect, reference_data
+from dialog import DialogState
+from metrics import metrics
+from outbox import Outbox
+from prefetch import PhotoQueue, StillSearching
+from registry import UserRegistry
+from search import SearchStream
+from seen import SeenIndex
+from vk_scheduler import ScheduledVkApi
+from vk_scope import VKDatingUser, VKAuth
+
+
+# поля datinguser, из которых собирается VKDatingUser
+CANDIDATE_FIELDS = (
+    DatingUser.id,
+    DatingUser.vk_id,
+    DatingUser.first_name,
+    DatingUser.last_name,
+    DatingUser.link,
+)
 
 
 class Bot(VKAuth, Connect):
+    # сколько следующих кандидатов подгружаем заранее
+    PREFETCH_DEPTH = 3
+
+    # сколько поисков одновременно могут дочитывать результаты за пределами первой 1000
+    SEARCH_WORKERS = 4
+
+    # сколько пользователей и сколько секунд с их последнего сообщения держим в памяти
+    REGISTRY_SIZE = 10000
+    REGISTRY_TTL = 3600
+
+    # по сколько юзеров читать из БД при просмотре сохранённых результатов
+    DATINGUSERS_PAGE = 20
+
+    # общий для всех пользователей кэш страниц users.search: сколько страниц и сколько секунд хранить
+    SEARCH_CACHE_SIZE = 128
+    SEARCH_CACHE_TTL = 600
+
+    # лимит запросов к API с токеном сообщества и число потоков отправки сообщений
+    MESSAGES_PER_SECOND = 20
+    OUTBOX_WORKERS = 4
+
     def __init__(self):
 
-        # Введите токен сообщества (группы) Вконтакте
-        TOKEN = 'HERE'
-        self.vk_bot = vk_api.VkApi(token=TOKEN, api_version='5.124')
-        self.longpoll = VkLongPoll(self.vk_bot)
+        # токен сообщества задаётся в config.py (VK_GROUP_TOKEN)
+        self.vk_bot = ScheduledVkApi(token=config.group_token, api_version=config.api_version,
+                                     rate=self.MESSAGES_PER_SECOND)
+        self.outbox = Outbox(self.vk_bot, workers=self.OUTBOX_WORKERS)
         self.empty_keyboard = VkKeyboard().get_empty_keyboard()
-        self.users = {}
+        self.registry = UserRegistry(self.REGISTRY_SIZE, self.REGISTRY_TTL)
+        self.seen = SeenIndex(self.REGISTRY_SIZE, self.REGISTRY_TTL)
+        self.search_pool = ThreadPoolExecutor(max_workers=self.SEARCH_WORKERS, thread_name_prefix='search')
+        self.search_cache = TTLCache(self.SEARCH_CACHE_SIZE, self.SEARCH_CACHE_TTL, name='search')
+
+        # справочники читаем из БД один раз при старте; соединение сразу возвращается в пул
+        with self.unit_of_work():
+            reference_data.load()
+
+        # обработчики ответов пользователя на каждом шаге диалога
+        self.handlers = {
+            DialogState.GREETING: self.on_greeting,
+            DialogState.CONFIRM: self.on_confirm,
+            DialogState.SEARCH_TYPE: self.on_search_type,
+            DialogState.SEX: self.on_sex,
+            DialogState.CITY: self.on_city,
+            DialogState.CITY_CHOICE: self.on_city_choice,
+            DialogState.AGE_FROM: self.on_age_from,
+            DialogState.AGE_TO: self.on_age_to,
+            DialogState.STATUS: self.on_status,
+            DialogState.SORT: self.on_sort,
+            DialogState.BROWSING: self.on_browsing,
+        }
+
+    @cached_property
+    def longpoll(self) -> VkLongPoll:
+        """Подключение к Long Poll серверу - при первом чтении событий, а не при создании бота"""
+        return VkLongPoll(self.vk_bot)
 
     """Служебные методы"""
 
     def _check_city_and_region(self, user) -> None:
         """Метод проверки наличия города и региона в БД. При отсутствии - собираем и дописываем"""
 
-        if not self.select_from_db(City.id, City.id == user.city['id']).first():
+        if not reference_data.has_city(user.city['id']):
             city, region = self._get_city(user.country['id'], user.city['title'])
-            if not self.select_from_db(Region.id, Region.id == region['id']).first():
-                self.insert_to_db(Region, region)
-            self.insert_to_db(City, city)
+            with self.batch():
+                if region and not reference_data.has_region(region['id']):
+                    self.insert_to_db(Region, region)
+                self.insert_to_db(City, city)
+            if region:
+                reference_data.add_region(region)
+            reference_data.add_city(city)
 
     def _get_region(self, country_id: int, region_title: str) -> Dict[str, Any]:
         """Метод для поиска региона юзера, если его вдруг нет в БД"""
@@ -66,52 +140,53 @@ class Bot(VKAuth, Connect):
     """Технические методы"""
 
     def write_msg(self, user_id, message, attachment=None, keyboard=None) -> None:
-        """Отправка сообщения пользователю"""
+        """Отправка сообщения пользователю через очередь исходящих"""
         values = {'user_id': user_id, 'message': message, 'random_id': randrange(10 ** 7)}
         if attachment:
             values['attachment'] = attachment
         if keyboard:
             values['keyboard'] = keyboard
 
-        self.vk_bot.method('messages.send', values)
+        self.outbox.send(values)
+
+    def dispatch_many(self, events) -> None:
+        """Обработка пачки событий одного опроса longpoll: профили новых собеседников запрашиваются разом"""
+        events = [event for event in events if event.type == VkEventType.MESSAGE_NEW and event.to_me]
+        try:
+            self.registry.prefetch(event.user_id for event in events)
+        except Exception as error:
+            # не вышло пачкой - профили загрузятся по одному в dispatch
+            print(f'Не удалось загрузить профили пользователей: {error!r}')
+        for event in events:
+            self.dispatch(event)
+
+    def dispatch(self, event) -> None:
+        """Маршрутизация события longpoll в диалог пользователя, от которого оно пришло.
+        Каждый шаг диалога - отдельная единица работы с БД со своей сессией,
+        а его сообщения уходят в очередь исходящих разом, после завершения шага."""
+        if event.type != VkEventType.MESSAGE_NEW or not event.to_me:
+            return
 
-    def listen_msg(self, scan=True) -> Tuple:
-        """Ожидание сообщений от пользователя и их обработка."""
+        with tracing.trace('dispatch', user_id=event.user_id, text=event.text):
+            try:
+                with self.outbox.step(), self.unit_of_work():
+                    self._dispatch(event)
+            except Exception as error:
+                # ошибка в диалоге одного пользователя не должна останавливать остальных
+                dialog = self.registry.find_dialog(event.user_id)
+                print(f'Ошибка в диалоге с пользователем {event.user_id} ({dialog}): {error!r}')
+                if dialog:
+                    self.finish_dialog(dialog)
 
-        def scan_request(event) -> str:
-            """Разбор сообщений от пользователя c удалением знаков препинания, чисткой пробелов"""
-            request = event.text.lower().strip()
-            query = re.findall(r'([А-Яа-яЁёA-Za-z0-9]+)', request)
-            if len(query) > 1:
-                query = ' '.join(query)
-            else:
-                try:
-                    query = query[0]
-                except IndexError:
-                    query = request
-            return query
+    def _dispatch(self, event) -> None:
+        user = self.registry.get_user(event.user_id)
+        dialog = self.registry.get_dialog(user)
 
-        for event in self.longpoll.listen():
-            try:
-                user = self.users.get(event.user_id)
-                if not user:
-                    user = self.create_user(event.user_id)
-
-                if not user.welcomed:
-                    self.welcome_user(user)
-
-                if event.type == VkEventType.MESSAGE_NEW:
-                    if event.to_me:
-                        if scan is True:
-                            return scan_request(event), user
-                        return event.text, user
-            except AttributeError:
-                pass
-
-    def create_user(self, id):
-        self.users[id] = VKUser(id)
-        user = self.users[id]
-        return user
+        tracing.annotate(state=dialog.state)
+        if not user.welcomed:
+            self.welcome_user(user)
+
+        self.handlers[dialog.state](dialog, event.text)
 
     def check_user_city(self, user):
 
@@ -140,12 +215,26 @@ class Bot(VKAuth, Connect):
             'sort_id': search_values['sort'],
             'user_id': user_id
         }
-        self.insert_to_db(Query, fields)
-
-        return self.select_from_db(Query.id, Query.id == Query.id).order_by(Query.datetime.desc()).first()[0]
-
-    def search_users(self, vk_user, values: Dict[str, Any] = None) -> Tuple[int, int] or None:
-        """ Метод поиска подходящих юзеров по запросу пользователя"""
+        return self.insert_returning_id(Query, fields)
+
+    def search_page(self, search_values: Dict[str, Any], cache: bool = True) -> Tuple[int, List[Dict[str, Any]]]:
+        """ Одна страница users.search: общее количество найденных и до 1000 юзеров.
+        Одинаковые запросы разных пользователей в течение SEARCH_CACHE_TTL обходятся одним вызовом API,
+        просмотренные каждым пользователем юзеры отсеиваются уже после кэша, в ingest.
+        Страницы окон потокового поиска (cache=False) в кэш не попадают: их много, и повторно они почти не нужны,
+        а вытеснили бы из него первые страницы поисков, которые и повторяются у разных пользователей."""
+        key = tuple(sorted((name, str(value)) for name, value in search_values.items() if value is not None))
+        page = self.search_cache.get(key) if cache else None
+        if page is None:
+            response = self.vk_session.method('users.search', values=search_values)
+            page = response['count'], response['items']
+            if cache:
+                self.search_cache.set(key, page)
+        return page
+
+    def search_users(self, vk_user, values: Dict[str, Any] = None) -> SearchStream or None:
+        """ Метод поиска подходящих юзеров по запросу пользователя.
+        Первая страница результатов записывается сразу, остальные - в фоне по мере обхода окон поиска."""
 
         search_values = {
             'city': 1,
@@ -164,161 +253,160 @@ class Bot(VKAuth, Connect):
         if values:
             search_values.update(values)
 
-        users_list = self.vk_session.method('users.search', values=search_values)['items']
+        total, users_list = self.search_page(search_values)
 
         if not users_list:
             return
-        query_id = self.insert_query(vk_user.user_id, search_values)
-        dusers = 0
+        with self.batch():
+            query_id = self.insert_query(vk_user.user_id, search_values)
+            stream = SearchStream(self, vk_user, search_values, query_id, total)
+            stream.put(self.ingest(vk_user, query_id, search_values['city'], users_list, stream.ingested))
+        stream.start(self.search_pool)
+        return stream
+
+    def ingest(self, vk_user, query_id: int, city_id: int, users_list: List[Dict[str, Any]],
+               exclude: set) -> List[VKDatingUser]:
+        """ Запись страницы результатов поиска в БД одной транзакцией.
+        Возвращает кандидатов для показа; их vk_id добавляются в exclude, чтобы не взять их повторно."""
+        city_title = reference_data.city_title(city_id)
+
+        # приводим всю страницу результатов к строкам таблицы в памяти
+        candidates = {}
         for user in users_list:
-            if user['is_closed'] == 1:
+            if user['is_closed'] == 1 or user['id'] in exclude:
                 continue
-
-            user['vk_id'] = user.pop('id')
-            user['city_id'] = search_values['city']
-            user['city_title'] = self.select_from_db(City.title, City.id == search_values['city']).first()[0]
-            user['link'] = 'https://vk.com/' + user.pop('domain')
-            user['verified'] = user.get('verified')
-            user['query_id'] = query_id
-            user['viewed'] = False
-
-            user.pop('is_closed')
-            user.pop('can_access_closed')
-            user.pop('track_code')
-
-            shown_user = self.select_from_db(DatingUser.viewed, (DatingUser.vk_id == user['vk_id'],
-                                                                 DatingUser.query_id == query_id)).first()
-            if shown_user:
-                if shown_user[0] is True:
-                    continue
-                elif shown_user[0] is False:
-                    last_query = self.select_from_db(Query.id,
-                                                     Query.user_id == user.user_id).order_by(
-                        Query.datetime.desc()).first()[0]
-
-                    self.update_data(DatingUser.id,
-                                     expression=(DatingUser.vk_id == user['vk_id'],
-                                                 DatingUser.query_id == last_query,
-                                                 DatingUser.viewed.is_(False)),
-                                     fields={DatingUser.query_id: query_id})
-                    dusers += 1
+            candidates[user['id']] = {
+                'vk_id': user['id'],
+                'first_name': user.get('first_name'),
+                'last_name': user.get('last_name'),
+                'city_id': city_id,
+                'city_title': city_title,
+                'link': 'https://vk.com/' + user['domain'],
+                'verified': user.get('verified'),
+                'query_id': query_id,
+                'viewed': False,
+            }
+        exclude.update(candidates)
+
+        # уже оценённых пользователем отсеиваем в памяти
+        for vk_id in self.seen.get(vk_user.user_id).intersection(candidates):
+            candidates.pop(vk_id)
+
+        # одним запросом находим тех, кто попадался пользователю в прошлых поисках, но ещё не оценён
+        not_viewed = set()
+        if candidates:
+            not_viewed = {vk_id for vk_id, in self.select_from_db(DatingUser.vk_id,
+                                                                   (Query.user_id == vk_user.user_id,
+                                                                    DatingUser.vk_id.in_(list(candidates)),
+                                                                    DatingUser.viewed.is_(False)),
+                                                                   join=Query)}
+        for vk_id in not_viewed:
+            candidates.pop(vk_id)
+
+        # непросмотренных переносим в новый запрос, новых дописываем
+        rows = []
+        with self.batch():
+            if not_viewed:
+                user_queries = self.select_from_db(Query.id, Query.user_id == vk_user.user_id).subquery()
+                table = DatingUser.__table__
+                stmt = table.update().where(DatingUser.vk_id.in_(not_viewed)).where(
+                    DatingUser.query_id.in_(user_queries)).where(DatingUser.viewed.is_(False)).values(
+                    query_id=query_id).returning(*CANDIDATE_FIELDS)
+                rows.extend(self.session.execute(stmt).fetchall())
+            rows.extend(self.bulk_insert_returning(DatingUser, list(candidates.values()), *CANDIDATE_FIELDS))
+
+        return [VKDatingUser(*row) for row in rows]
+
+    def show_results(self, dialog, datingusers=None, found: int = None) -> None:
+        """Метод выдачи пользователю результатов поиска: диалог переходит в режим просмотра кандидатов.
+        datingusers - список или поток кандидатов (SearchStream), found - сколько нашёл поиск."""
+        user = dialog.user
+        if found:
+            remainder = found % 10
+            if remainder == 0 or remainder >= 5 or (10 <= found <= 19) or (10 <= found % 100 <= 19):
+                var = 'вариантов'
+            elif remainder == 1:
+                var = 'вариант'
             else:
-                self.insert_to_db(DatingUser, user)
-                dusers += 1
+                var = 'варианта'
+            self.write_msg(user.user_id, f'&#128515; Мы нашли {found} {var}!!!')
+
+        dialog.candidates = PhotoQueue(datingusers or [], self.PREFETCH_DEPTH)
+        dialog.state = DialogState.BROWSING
+        self.show_next(dialog)
+
+    def show_next(self, dialog) -> None:
+        """Показ пользователю следующего кандидата из результатов поиска"""
+        user = dialog.user
+        try:
+            d_user = next(dialog.candidates, None)
+        except StillSearching:
+            # диспетчер не ждёт поиска: следующий кандидат будет показан в ответ на следующее сообщение
+            dialog.current = None
+            self.write_msg(user.user_id, "&#8987; Ищу ещё варианты... Нажми \"Дальше\" через пару секунд.",
+                           keyboard=wait_buttons())
+            return
+        if d_user is None:
+            self.write_msg(user.user_id,
+                           "&#128579; Похоже, что ты уже всех посмотрел. Попробуй новый поиск! &#128373;",
+                           keyboard=self.empty_keyboard)
+            self.finish_dialog(dialog)
+            return
 
-        return dusers, query_id
+        dialog.current = d_user
+        name = d_user.first_name + ' ' + d_user.last_name
+        link = d_user.link
+        if len(d_user.photos) > 1:
+            photos_list = []
+            for photo in d_user.photos:
+                photo_id, owner_id = photo
+                photos_list.append(f'photo{owner_id}_{photo_id}')
+            photos = ','.join(photos_list)
+            message = f'{name} {link} \n '
+        elif len(d_user.photos) == 1:
+            photo_id, owner_id = d_user.photos[0]
+            photos = f'photo{owner_id}_{photo_id}'
+            message = f'{name} {link} \n '
+        else:
+            message = f'{name} {link} \n Фоток нет, но вы держитесь!\n'
+            photos = ''
 
-    def show_results(self, user, results: Tuple[int, int] = None, datingusers: List[VKDatingUser] = None) -> None:
-        """Метод выдачи пользователю результатов поиска"""
-        if datingusers:
-            dating_users = datingusers
+        if photos:
+            self.write_msg(user.user_id, message=message, attachment=photos)
         else:
-            if results:
-                remainder = results[0] % 10
-                if remainder == 0 or remainder >= 5 or (10 <= results[0] <= 19) or (10 <= results[0] % 100 <= 19):
-                    var = 'вариантов'
-                elif remainder == 1:
-                    var = 'вариант'
-                else:
-                    var = 'варианта'
-                self.write_msg(user.user_id, f'&#128515; Мы нашли {results[0]} {var}!!!')
-                query_id = results[1]
-                dating_users = self.get_datingusers_from_db(user.user_id, query_id)
-            else:
-                dating_users = self.get_datingusers_from_db(user.user_id)
-
-        if dating_users:
-            # получаем список юзеров из БД
-            for d_user in dating_users:
-                d_user.photos = d_user.get_photo()
-                name = d_user.first_name + ' ' + d_user.last_name
-                link = d_user.link
-                if len(d_user.photos) > 1:
-                    photos_list = []
-                    for photo in d_user.photos:
-                        photo_id, owner_id = photo
-                        photos_list.append(f'photo{owner_id}_{photo_id}')
-                    photos = ','.join(photos_list)
-                    message = f'{name} {link} \n '
-                elif len(d_user.photos) == 1:
-                    photo_id, owner_id = d_user.photos[0]
-                    photos = f'photo{owner_id}_{photo_id}'
-                    message = f'{name} {link} \n '
-                else:
-                    message = f'{name} {link} \n Фоток нет, но вы держитесь!\n'
-                    photos = ''
-
-                keyboard = VkKeyboard(one_time=False)
-                keyboard.add_button("Да", color=VkKeyboardColor.POSITIVE)
-                keyboard.add_button("Нет", color=VkKeyboardColor.NEGATIVE)
-                keyboard.add_line()
-                keyboard.add_button("Отмена", color=VkKeyboardColor.NEGATIVE)
-                keyboard = keyboard.get_keyboard()
-                if photos:
-                    self.write_msg(user.user_id, message=message, attachment=photos)
-                else:
-                    self.write_msg(user.user_id, message=message)
-                self.write_msg(user.user_id, message='Нравится?', keyboard=keyboard)
-
-                expected_answers = ['да', 'нет', 'отмена']
-                answer = self.listen_msg()[0]
-                while answer not in expected_answers:
-                    self.write_msg(user.user_id, "&#129300; Не понимаю... Используй кнопки. &#128071;",
-                                   keyboard=keyboard)
-                    answer = self.listen_msg()[0]
-                else:
-                    if answer == "да":
-                        fields = {DatingUser.viewed: True, DatingUser.black_list: False}
-                        self.update_data(DatingUser.id, DatingUser.id == d_user.db_id, fields=fields)
-                        continue
-                    elif answer == "нет":
-                        fields = {DatingUser.viewed: True, DatingUser.black_list: True}
-                        self.update_data(DatingUser.id, DatingUser.id == d_user.db_id, fields=fields)
-                        continue
-                    elif answer == "отмена":
-                        self.write_msg(user.user_id, "Заходи ещё! &#128406;",
-                                       keyboard=self.empty_keyboard)
-                        return
-        self.write_msg(user.user_id, "&#128579; Похоже, что ты уже всех посмотрел. Попробуй новый поиск! &#128373;",
-                       keyboard=self.empty_keyboard)
-        return
-
-    def get_datingusers_from_db(self, user_id, query_id=None, blacklist=None) -> List or int:
-        """Метод получения юзеров из БД и создания из них экземпляров класса"""
-        fields = (
-            DatingUser.id,
-            DatingUser.vk_id,
-            DatingUser.first_name,
-            DatingUser.last_name,
-            DatingUser.link,
-        )
+            self.write_msg(user.user_id, message=message)
+        self.write_msg(user.user_id, message='Нравится?', keyboard=rate_buttons())
+
+    def get_datingusers_from_db(self, user_id, query_id=None, blacklist=None) -> Iterator[VKDatingUser]:
+        """ Метод получения юзеров из БД и создания из них экземпляров класса.
+        Юзеры читаются лениво, страницами по DATINGUSERS_PAGE строк по возрастанию id (keyset-пагинация):
+        следующая страница запрашивается, только когда пользователь досмотрел предыдущую."""
 
         if query_id and blacklist:
             raise AttributeError("Не нужно передавать в эту функцию одновременно query_id и blacklist")
 
+        join = None
         if query_id:
-            vk_users = self.select_from_db(fields, (DatingUser.query_id == query_id,
-                                                    DatingUser.viewed.is_(False))).all()
+            expression = (DatingUser.query_id == query_id, DatingUser.viewed.is_(False))
+        elif blacklist is None:
+            last_query = self.select_from_db(Query.id,
+                                             Query.user_id == user_id).order_by(Query.datetime.desc()).first()
+            if not last_query:
+                return
+            expression = (DatingUser.query_id == last_query[0], DatingUser.viewed.is_(False))
         else:
-            if blacklist is None:
-                query_id = self.select_from_db(Query.id,
-                                               Query.user_id == user_id).order_by(Query.datetime.desc()).first()[0]
-                vk_users = self.select_from_db(fields, (DatingUser.query_id == query_id,
-                                                        DatingUser.viewed.is_(False))).all()
+            join = Query
+            expression = (Query.user_id == user_id, DatingUser.black_list.is_(blacklist))
 
-            elif blacklist is False:
-                vk_users = self.select_from_db(model_fields=fields,
-                                               join=Query,
-                                               expression=(Query.user_id == user_id, DatingUser.black_list.is_(False)))
-
-            else:
-                vk_users = self.select_from_db(model_fields=fields,
-                                               join=Query,
-                                               expression=(Query.user_id == user_id, DatingUser.black_list.is_(True)))
-        if vk_users:
-            datingusers = [VKDatingUser(user[0], user[1], user[2], user[3], user[4]) for user in vk_users]
-            return datingusers
-        return
+        last_id = 0
+        while True:
+            vk_users = self.select_from_db(CANDIDATE_FIELDS, (*expression, DatingUser.id > last_id),
+                                           join=join).order_by(DatingUser.id).limit(self.DATINGUSERS_PAGE).all()
+            for user in vk_users:
+                yield VKDatingUser(*user)
+            if len(vk_users) < self.DATINGUSERS_PAGE:
+                return
+            last_id = vk_users[-1][0]
 
     """Сценарные методы"""
 
@@ -360,10 +448,127 @@ class Bot(VKAuth, Connect):
         user.welcomed = True
         return user.welcomed
 
-    def get_sex(self, user):
-        # пол
-        sex = [name[0] for name in user.select_from_db(Sex.title, Sex.id == Sex.id).all()]
+    def finish_dialog(self, dialog) -> None:
+        """Завершение сценария: следующее сообщение пользователя начнёт диалог заново"""
+        dialog.reset()
+        dialog.user.welcomed = False
+
+    def cancel_dialog(self, dialog) -> None:
+        """Выход пользователя из опросника"""
+        self.write_msg(dialog.user.user_id, f'&#128521; Ок, давай начнём сначала.', keyboard=self.empty_keyboard)
+        self.finish_dialog(dialog)
+
+    def send_list(self, user, dating_users) -> bool:
+        """ Отправка пользователю списка юзеров, разбитого на сообщения допустимой длины.
+        Возвращает False, если список пуст"""
+        message = ''
+        for num, d_user in enumerate(dating_users, start=1):
+            if len(message + f'{num}. {d_user}\n') > 4097:  # предельная длина сообщения ВК
+                self.write_msg(user.user_id, message)
+                message = ''
+            message += f'{num}. {d_user}\n'
+        if message:
+            self.write_msg(user.user_id, message)
+        return bool(message)
+
+    def on_greeting(self, dialog, text) -> None:
+        """Основной сценарий развития диалога пользователя с ботом: выбор действия"""
+        user = dialog.user
+        answer = scan_request(text)
+
+        dialog.search_values = {
+            'city': user.city['id'],
+            'sex': None,
+            'age_from': 18,
+            'age_to': 100,
+            'status': 6,
+            'sort': 0,
+        }
+
+        if answer == "привет":
+            keyboard = VkKeyboard(one_time=False)
+            keyboard.add_button("Да", VkKeyboardColor.POSITIVE)
+            keyboard.add_button("Нет", VkKeyboardColor.NEGATIVE)
+
+            # для мальчиков
+            if user.sex == 2:
+                dialog.search_values['sex'] = 1
+                self.write_msg(user.user_id, f"Хочешь найти девушку?", keyboard=keyboard.get_keyboard())
+                dialog.state = DialogState.CONFIRM
+
+            # для девочек
+            elif user.sex == 1:
+                dialog.search_values['sex'] = 2
+                self.write_msg(user.user_id, f"Хочешь найти парня?", keyboard=keyboard.get_keyboard())
+                dialog.state = DialogState.CONFIRM
+
+            # для неопределившихся
+            else:
+                self.ask_sex(dialog)
+
+        elif answer == "новый поиск":
+            self.ask_sex(dialog)
+
+        elif answer == "результаты последнего поиска":
+            self.show_results(dialog, datingusers=self.get_datingusers_from_db(user.user_id))
+
+        elif answer == "все лайкнутые":
+            if self.send_list(user, self.get_datingusers_from_db(user.user_id, blacklist=False)):
+                self.show_results(dialog, datingusers=self.get_datingusers_from_db(user.user_id, blacklist=False))
+            else:
+                self.show_results(dialog)
+
+        elif answer == "все непонравившиеся":
+            if self.send_list(user, self.get_datingusers_from_db(user.user_id, blacklist=True)):
+                self.show_results(dialog, datingusers=self.get_datingusers_from_db(user.user_id, blacklist=True))
+            else:
+                self.show_results(dialog)
+
+        else:
+            self.write_msg(user.user_id, "&#129300; Не понимаю... Используй кнопки. &#128071;")
+
+    def on_confirm(self, dialog, text) -> None:
+        """ Начальный опросник пользователя для поиска подходящих юзеров"""
+        user = dialog.user
+        answer = scan_request(text)
+        if answer == 'да':
+            keyboard = VkKeyboard(one_time=False)
+            keyboard.add_button("стандартный", VkKeyboardColor.PRIMARY)
+            keyboard.add_button("детализированный", VkKeyboardColor.SECONDARY)
+            keyboard.add_line()
+            keyboard.add_button("Отмена", VkKeyboardColor.NEGATIVE)
+            keyboard = keyboard.get_keyboard()
+            self.write_msg(user.user_id, f"Какой вид поиска будем использовать? &#128071;", keyboard=keyboard)
+            dialog.state = DialogState.SEARCH_TYPE
+        elif answer == 'нет':
+            self.ask_sex(dialog)
+        else:
+            self.write_msg(user.user_id, '&#129300; Не понимаю... Просто скажи "да" или "нет" '
+                                         'или используй кнопки. &#128071;')
+
+    def on_search_type(self, dialog, text) -> None:
+        user = dialog.user
+        answer = scan_request(text)
+        if answer == "стандартный":
+            self.write_msg(user.user_id, f"&#128077; Прекрасный выбор!")
+            self.run_search(dialog)
+        elif answer == "детализированный":
+            self.write_msg(user.user_id, f"&#128076; Ок! Тогда тебе нужно будет ответить на несколько вопросов.")
+            self.ask_city(dialog)
+        elif answer == "отмена":
+            self.cancel_dialog(dialog)
+        else:
+            self.write_msg(user.user_id, '&#129300; Не понимаю... Используй кнопки. &#128071;')
+
+    def get_sex(self, user) -> List[str]:
+        sex = reference_data.sex_titles()
         sex.append("отмена")
+        return sex
+
+    def ask_sex(self, dialog) -> None:
+        # пол
+        user = dialog.user
+        sex = self.get_sex(user)
 
         keyboard = VkKeyboard(one_time=False)
         keyboard.add_button(sex[1].capitalize(), VkKeyboardColor.NEGATIVE)
@@ -374,138 +579,143 @@ class Bot(VKAuth, Connect):
         keyboard = keyboard.get_keyboard()
 
         self.write_msg(user.user_id, f'Людей какого пола мы будем искать?', keyboard=keyboard)
+        dialog.state = DialogState.SEX
 
-        answer = self.listen_msg()[0].strip().lower()
-
-        while answer not in sex:
+    def on_sex(self, dialog, text) -> None:
+        user = dialog.user
+        sex = self.get_sex(user)
+        answer = scan_request(text).strip().lower()
+        if answer not in sex:
             self.write_msg(user.user_id, '&#129300; Не понимаю... Используй кнопки. &#128071;')
-            answer = self.listen_msg()[0].strip().lower()
+        elif answer == "отмена":
+            self.cancel_dialog(dialog)
         else:
-            if answer == "отмена":
-                return
-            return sex.index(answer)
+            dialog.search_values['sex'] = sex.index(answer)
+            self.ask_city(dialog)
 
-    def get_city(self, user):
+    def ask_city(self, dialog) -> None:
         # город
-        self.write_msg(user.user_id, f'В каком городе будем искать?\n\nНазвания зарубежных городов, таких как Амстердам '
-                                     f'или Пекин, должны быть написаны латиницей и полностью.',
+        self.write_msg(dialog.user.user_id, f'В каком городе будем искать?\n\nНазвания зарубежных городов, '
+                                            f'таких как Амстердам или Пекин, должны быть написаны латиницей '
+                                            f'и полностью.',
                        keyboard=cancel_button())
-        while True:
-            answer = self.listen_msg(scan=False)[0].strip().lower()
-            if answer == "отмена":
+        dialog.state = DialogState.CITY
+
+    def on_city(self, dialog, text) -> None:
+        user = dialog.user
+        answer = text.strip().lower()
+        if answer == "отмена":
+            self.cancel_dialog(dialog)
+            return
+
+        city = reference_data.find_cities(answer)
+
+        if not city:
+            self.write_msg(user.user_id, f'&#128530; Я пока не знаю такого города. '
+                                         f'Выбери другой или попробуй написать иначе. '
+                                         f'Пробелы и дефисы в названии играют большую роль.')
+            return
+
+        exact = [row for row in city if row[1].lower() == answer]
+        if len(city) - len(exact) > reference_data.CITY_LIMIT:
+            if not exact:
+                self.write_msg(user.user_id, f'&#129300; Под это подходит слишком много городов. '
+                                             f'Напиши название полностью или хотя бы ещё несколько букв.')
                 return
-            try:
-                symbol = re.search(r'\W', answer)[0]
-                words = re.split(symbol, answer)
-                if len(words) < 3:
-                    for word in words:
-                        words[words.index(word)] = word.capitalize()
-                    answer = symbol.join(words)
-                else:
-                    if '-' == symbol:
-                        words[0] = words[0].capitalize()
-                        words[-1] = words[-1].capitalize()
-                        answer = symbol.join(words)
-                    else:
-                        answer = answer.title()
-            except TypeError:
-                answer = answer.capitalize()
-
-            city = user.select_from_db(City, City.title.startswith(answer)).order_by(City.region).all()
-
-            if not city:
-                self.write_msg(user.user_id, f'&#128530; Я пока не знаю такого города. '
-                                             f'Выбери другой или попробуй написать иначе. '
-                                             f'Пробелы и дефисы в названии играют большую роль.')
-            else:
-                break
+            # название введено полностью - предлагаем все города с ним, сколько бы их ни было
+            city = exact
 
         if len(city) == 1:
-            return city[0].id
-        elif len(city) > 1:
-            self.write_msg(user.user_id, f'Нужно уточнить, какой именно город ты имеешь в виду:')
-            ids = [(city.id, city.title) for city in city]
-            ids.sort(key=lambda x: x[0])
-            cities = {}
-
-            message_list = []
-            message = ''
-
-            for num, (id, title) in enumerate(ids, start=1):
-                cities[str(num)] = id
-
-                try:
-                    region_name, region_id, area = user.select_from_db((City.region, City.region_id, City.area),
-                                                                       City.id == id).first()
-
-                    country = user.select_from_db(Country.title, Region.id == region_id,
-                                                  join=(Region, Country.id == Region.country_id)).first()[0]
-                except TypeError:
-                    area = None
-                    region_name = 'Очень секретный район'
-                    country = 'Очень секретная страна'
-
-                if area:
-                    string = f'{num} - {title}, {region_name}, {area} ({country})\n'
-                else:
-                    string = f'{num} - {title}, {region_name} ({country})\n'
-
-                if len(message + string) > 4097:  # предельная длина сообщения ВК
-                    message_list.append(message)
-                    message = ''
-                message += string
-            message_list.append(message)
-            for message in message_list:
-                self.write_msg(user.user_id, message)
+            dialog.search_values['city'] = city[0][0]
+            self.ask_age_from(dialog)
+            return
 
-            expected_answers = [str(i) for i in range(1, len(city) + 1)]
-            answer = self.listen_msg()[0].strip()
-            expected_answers.append('отмена')
-            while answer not in expected_answers:
-                self.write_msg(user.user_id, f'Мне нужен один из порядковых номеров, которые ты видишь чуть выше.')
-                answer = self.listen_msg()[0].strip()
+        self.write_msg(user.user_id, f'Нужно уточнить, какой именно город ты имеешь в виду:')
+        dialog.cities = {}
+
+        message_list = []
+        message = ''
+
+        for num, (id, title, region_name, area, country) in enumerate(city, start=1):
+            dialog.cities[str(num)] = id
+
+            if country is None:
+                area = None
+                region_name = 'Очень секретный район'
+                country = 'Очень секретная страна'
+
+            if area:
+                string = f'{num} - {title}, {region_name}, {area} ({country})\n'
             else:
-                if answer == "отмена":
-                    return
-                return cities[answer]
+                string = f'{num} - {title}, {region_name} ({country})\n'
+
+            if len(message + string) > 4097:  # предельная длина сообщения ВК
+                message_list.append(message)
+                message = ''
+            message += string
+        message_list.append(message)
+        for message in message_list:
+            self.write_msg(user.user_id, message)
+        dialog.state = DialogState.CITY_CHOICE
+
+    def on_city_choice(self, dialog, text) -> None:
+        answer = scan_request(text).strip()
+        if answer == "отмена":
+            self.cancel_dialog(dialog)
+        elif answer not in dialog.cities:
+            self.write_msg(dialog.user.user_id, f'Мне нужен один из порядковых номеров, которые ты видишь чуть выше.')
+        else:
+            dialog.search_values['city'] = dialog.cities[answer]
+            dialog.cities = {}
+            self.ask_age_from(dialog)
 
-    def get_age_from(self, user):
+    def ask_age_from(self, dialog) -> None:
         # начальный возраст
-        self.write_msg(user.user_id, f'Укажи минимальный возраст в цифрах.', keyboard=cancel_button())
-        while True:
-            answer = self.listen_msg()[0].strip().lower()
-            try:
-                answer = int(answer)
-            except ValueError:
-                if answer == "отмена":
-                    return
-                else:
-                    self.write_msg(user.user_id, f'Укажи минимальный возраст в ЦИФРАХ.')
-            return abs(answer)
-
-    def get_age_to(self, user):
+        self.write_msg(dialog.user.user_id, f'Укажи минимальный возраст в цифрах.', keyboard=cancel_button())
+        dialog.state = DialogState.AGE_FROM
+
+    def on_age_from(self, dialog, text) -> None:
+        answer = scan_request(text).strip().lower()
+        try:
+            answer = int(answer)
+        except ValueError:
+            if answer == "отмена":
+                self.cancel_dialog(dialog)
+            else:
+                self.write_msg(dialog.user.user_id, f'Укажи минимальный возраст в ЦИФРАХ.')
+        else:
+            dialog.search_values['age_from'] = abs(answer)
+            self.ask_age_to(dialog)
+
+    def ask_age_to(self, dialog) -> None:
         # конечный возраст
-        self.write_msg(user.user_id, f'Укажи максимальный возраст в цифрах или отправь 0, если тебе это неважно.',
+        self.write_msg(dialog.user.user_id,
+                       f'Укажи максимальный возраст в цифрах или отправь 0, если тебе это неважно.',
                        keyboard=cancel_button())
-        while True:
-            answer = self.listen_msg()[0].strip().lower()
-            try:
-                answer = int(answer)
-            except ValueError:
-                if answer == "отмена":
-                    return
-                else:
-                    self.write_msg(user.user_id,
-                                   f'Укажи максимальный возраст в ЦИФРАХ или отправь 0, если тебе это неважно.')
+        dialog.state = DialogState.AGE_TO
+
+    def on_age_to(self, dialog, text) -> None:
+        answer = scan_request(text).strip().lower()
+        try:
+            answer = int(answer)
+        except ValueError:
+            if answer == "отмена":
+                self.cancel_dialog(dialog)
             else:
-                if answer != 0:
-                    return abs(answer)
-                return 100
+                self.write_msg(dialog.user.user_id,
+                               f'Укажи максимальный возраст в ЦИФРАХ или отправь 0, если тебе это неважно.')
+        else:
+            dialog.search_values['age_to'] = abs(answer) if answer != 0 else 100
+            self.ask_status(dialog)
 
-    def get_status(self, user):
-        # семейное положение
-        statuses = [name[0] for name in user.select_from_db(Status.title, Status.id == Status.id).all()]
+    def get_status(self, user) -> List[str]:
+        statuses = reference_data.status_titles()
         statuses.append("Отмена")
+        return statuses
+
+    def ask_status(self, dialog) -> None:
+        # семейное положение
+        statuses = self.get_status(dialog.user)
 
         keyboard = VkKeyboard(one_time=False)
         keyboard.add_button(statuses[0], VkKeyboardColor.POSITIVE)
@@ -523,252 +733,143 @@ class Bot(VKAuth, Connect):
         keyboard.add_button("Отмена", VkKeyboardColor.NEGATIVE)
         keyboard = keyboard.get_keyboard()
 
-        self.write_msg(user.user_id, f'Какой из статусов тебя интересует?', keyboard=keyboard)
+        self.write_msg(dialog.user.user_id, f'Какой из статусов тебя интересует?', keyboard=keyboard)
+        dialog.state = DialogState.STATUS
 
-        answer = self.listen_msg(scan=False)[0].strip()
-
-        while answer not in statuses:
-            self.write_msg(user.user_id, '&#129300; Не понимаю... Используй кнопки. &#128071;')
-            answer = self.listen_msg()[0].strip()
+    def on_status(self, dialog, text) -> None:
+        statuses = self.get_status(dialog.user)
+        answer = text.strip()
+        if answer not in statuses:
+            self.write_msg(dialog.user.user_id, '&#129300; Не понимаю... Используй кнопки. &#128071;')
+        elif answer == "Отмена":
+            self.cancel_dialog(dialog)
         else:
-            if answer == "Отмена":
-                return
-            return statuses.index(answer) + 1
+            dialog.search_values['status'] = statuses.index(answer) + 1
+            self.ask_sort(dialog)
 
-    def get_sort(self, user):
-        # сортировка
-        sort_names = [name[0] for name in user.select_from_db(Sort.title, Sort.id == Sort.id).all()]
+    def get_sort(self, user) -> List[str]:
+        sort_names = reference_data.sort_titles()
         sort_names.append("отмена")
+        return sort_names
+
+    def ask_sort(self, dialog) -> None:
+        # сортировка
+        sort_names = self.get_sort(dialog.user)
         keyboard = VkKeyboard(one_time=False)
         keyboard.add_button(sort_names[0], VkKeyboardColor.POSITIVE)
         keyboard.add_button(sort_names[1], VkKeyboardColor.PRIMARY)
         keyboard.add_line()
         keyboard.add_button("Отмена", VkKeyboardColor.NEGATIVE)
         keyboard = keyboard.get_keyboard()
-        self.write_msg(user.user_id, f'Как отсортировать пользователей?', keyboard=keyboard)
-
-        answer = self.listen_msg()[0].strip()
-        while answer not in sort_names:
-            self.write_msg(user.user_id, '&#129300; Не понимаю... Используй кнопки. &#128071;')
-            answer = self.listen_msg()[0].strip()
+        self.write_msg(dialog.user.user_id, f'Как отсортировать пользователей?', keyboard=keyboard)
+        dialog.state = DialogState.SORT
+
+    def on_sort(self, dialog, text) -> None:
+        sort_names = self.get_sort(dialog.user)
+        answer = scan_request(text).strip()
+        if answer not in sort_names:
+            self.write_msg(dialog.user.user_id, '&#129300; Не понимаю... Используй кнопки. &#128071;')
+        elif answer == "отмена":
+            self.cancel_dialog(dialog)
         else:
-            if answer == "отмена":
-                return
-            return sort_names.index(answer)
-
-    def questionnaire(self, user, values=None, full=False) -> Dict[str, Any] or int:
-        """ "Полный" пошаговый опросник пользователя для поиска подходящих юзеров: пол.
-        Остальные вопросы в "кратком" опроснике."""
-
-        search_values = {
-            'sex': None,
-            'city': None,
-            'age_from': None,
-            'age_to': None,
-            'status': None,
-            'sort': None,
-        }
-
-        if values:
-            search_values.update(values)
-
-        if full:
-            sex = self.get_sex(user)
-            if sex is None:
-                return
+            dialog.search_values['sort'] = sort_names.index(answer)
+            self.run_search(dialog)
+
+    def run_search(self, dialog) -> None:
+        """Поиск по собранным условиям и переход к просмотру результатов"""
+        user = dialog.user
+        stream = self.search_users(user, dialog.search_values)
+        if not stream:
+            self.write_msg(user.user_id,
+                           f'&#128530; Похоже, что в этом городе нет никого, кто отвечал бы таким '
+                           f'условиям поиска.\nПопробуй использовать детализированный поиск или '
+                           f'изменить условия запроса.', keyboard=self.empty_keyboard)
+            self.finish_dialog(dialog)
         else:
-            sex = search_values['sex']
-
-        city = self.get_city(user)
-        if city is None:
-            return
-
-        age_from = self.get_age_from(user)
-        if age_from is None:
-            return
-
-        age_to = self.get_age_to(user)
-        if age_to is None:
-            return
-
-        status = self.get_status(user)
-        if status is None:
-            return
-
-        sort = self.get_sort(user)
-        if sort is None:
-            return
+            self.show_results(dialog, datingusers=stream, found=stream.total)
+
+    def on_browsing(self, dialog, text) -> None:
+        """Оценка пользователем показанного кандидата"""
+        user = dialog.user
+        d_user = dialog.current
+        answer = scan_request(text)
+        if d_user is None and answer != "отмена":
+            # предыдущий кандидат уже оценён, а следующий тогда ещё искался
+            self.show_next(dialog)
+        elif answer in ("да", "нет"):
+            fields = {DatingUser.viewed: True, DatingUser.black_list: answer == "нет"}
+            with self.batch():
+                self.update_data(DatingUser.id, DatingUser.id == d_user.db_id, fields=fields)
+                self.seen.add(user.user_id, d_user.id)
+            self.show_next(dialog)
+        elif answer == "отмена":
+            self.write_msg(user.user_id, "Заходи ещё! &#128406;", keyboard=self.empty_keyboard)
+            self.finish_dialog(dialog)
+        else:
+            self.write_msg(user.user_id, "&#129300; Не понимаю... Используй кнопки. &#128071;",
+                           keyboard=rate_buttons())
 
-        search_values['sex'] = sex
-        search_values['city'] = city
-        search_values['age_from'] = age_from
-        search_values['age_to'] = age_to
-        search_values['status'] = status
-        search_values['sort'] = sort
 
-        return search_values
+def scan_request(text: str) -> str:
+    """Разбор сообщений от пользователя c удалением знаков препинания, чисткой пробелов"""
+    request = text.lower().strip()
+    query = re.findall(r'([А-Яа-яЁёA-Za-z0-9]+)', request)
+    if len(query) > 1:
+        query = ' '.join(query)
+    else:
+        try:
+            query = query[0]
+        except IndexError:
+            query = request
+    return query
 
-    def initial_questionnaire(self, user, search_values) -> Tuple[int, int] or int:
-        """ Начальный пошаговый опросник пользователя для поиска подходящих юзеров"""
-        expected_answers = ['да', 'нет']
-        answer = self.listen_msg()[0].strip()
-        while answer not in expected_answers:
-            self.write_msg(user.user_id, '&#129300; Не понимаю... Просто скажи "да" или "нет" '
-                                         'или используй кнопки. &#128071;')
-            answer = self.listen_msg()[0].strip()
-        else:
-            if answer == 'да':
 
-                keyboard = VkKeyboard(one_time=False)
-                keyboard.add_button("стандартный", VkKeyboardColor.PRIMARY)
-                keyboard.add_button("детализированный", VkKeyboardColor.SECONDARY)
-                keyboard.add_line()
-                keyboard.add_button("Отмена", VkKeyboardColor.NEGATIVE)
-                keyboard = keyboard.get_keyboard()
-                self.write_msg(user.user_id, f"Какой вид поиска будем использовать? &#128071;", keyboard=keyboard)
-
-                expected_answers = ["стандартный", "детализированный", "отмена"]
-                answer = self.listen_msg()[0].strip()
-                while answer not in expected_answers:
-                    self.write_msg(user.user_id, '&#129300; Не понимаю... Используй кнопки. &#128071;')
-                    answer = self.listen_msg()[0].strip()
-                else:
-                    if answer == "стандартный":
-                        self.write_msg(user.user_id, f"&#128077; Прекрасный выбор!")
-                        return search_values
-                    elif answer == "детализированный":
-                        self.write_msg(user.user_id,
-                                       f"&#128076; Ок! Тогда тебе нужно будет ответить на несколько вопросов.")
-                        return self.questionnaire(user, search_values)
-                    else:
-                        return
-            elif answer == 'нет':
-                return self.questionnaire(user, full=True)
-
-    def start(self):
-        """Основной метод работы бота, отвечающий за сценарий развития диалога пользователя с ботом."""
-
-        answer, user = self.listen_msg()
+def cancel_button() -> VkKeyboard:
+    """Кнопка экстренного выхода из диалога с ботом"""
+    keyboard = VkKeyboard(one_time=False)
+    keyboard.add_button("Отмена", color=VkKeyboardColor.NEGATIVE)
+    return keyboard.get_keyboard()
 
-        search_values = {
-            'city': user.city['id'],
-            'sex': None,
-            'age_from': 18,
-            'age_to': 100,
-            'status': 6,
-            'sort': 0,
-        }
 
-        expected_answers = ['привет', 'новый поиск', "результаты последнего поиска",
-                            "все лайкнутые", "все непонравившиеся"]
-        while answer not in expected_answers:
-            self.write_msg(user.user_id, "&#129300; Не понимаю... Используй кнопки. &#128071;")
-            answer = self.listen_msg()[0]
-        else:
-            if answer == "привет":
-                keyboard = VkKeyboard(one_time=False)
-                keyboard.add_button("Да", VkKeyboardColor.POSITIVE)
-                keyboard.add_button("Нет", VkKeyboardColor.NEGATIVE)
-
-                # для мальчиков
-                if user.sex == 2:
-                    search_values['sex'] = 1
-                    self.write_msg(user.user_id, f"Хочешь найти девушку?", keyboard=keyboard.get_keyboard())
-                    search_values = self.initial_questionnaire(user, search_values)
-
-                # для девочек
-                elif user.sex == 1:
-                    search_values['sex'] = 2
-                    self.write_msg(user.user_id, f"Хочешь найти парня?", keyboard=keyboard.get_keyboard())
-                    search_values = self.initial_questionnaire(user, search_values)
-
-                # для неопределившихся
-                else:
-                    search_values = self.questionnaire(user, full=True)
-
-                if search_values:
-                    return user, search_values
-                return user, None
-
-            elif answer == "новый поиск":
-                search_values = self.questionnaire(user, full=True)
-                if search_values:
-                    return user, search_values
-                return user, None
-
-            elif answer == "результаты последнего поиска":
-                last_user_query = self.get_datingusers_from_db(user.user_id)
-                if last_user_query:
-                    return user, last_user_query
-                return user
-
-            elif answer == "все лайкнутые":
-                liked_users = self.get_datingusers_from_db(user.user_id, blacklist=False)
-                if liked_users:
-                    message_list = []
-                    message = ''
-                    for num, d_user in enumerate(liked_users, start=1):
-                        if len(message + f'{num}. {d_user}\n') > 4097:  # предельная длина сообщения ВК
-                            message_list.append(message)
-                            message = ''
-                        message += f'{num}. {d_user}\n'
-                    message_list.append(message)
-                    for message in message_list:
-                        self.write_msg(user.user_id, message)
-                    return user, liked_users
-                return user
-
-            elif answer == "все непонравившиеся":
-                blacklist = self.get_datingusers_from_db(user.user_id, blacklist=True)
-                if blacklist:
-                    message_list = []
-                    message = ''
-                    for num, d_user in enumerate(blacklist, start=1):
-                        if len(message + f'{num}. {d_user}\n') > 4097:  # предельная длина сообщения ВК
-                            message_list.append(message)
-                            message = ''
-                        message += f'{num}. {d_user}\n'
-                    message_list.append(message)
-                    for message in message_list:
-                        self.write_msg(user.user_id, message)
-                    return user, blacklist
-                return user
+def rate_buttons() -> VkKeyboard:
+    """Кнопки оценки кандидата"""
+    keyboard = VkKeyboard(one_time=False)
+    keyboard.add_button("Да", color=VkKeyboardColor.POSITIVE)
+    keyboard.add_button("Нет", color=VkKeyboardColor.NEGATIVE)
+    keyboard.add_line()
+    keyboard.add_button("Отмена", color=VkKeyboardColor.NEGATIVE)
+    return keyboard.get_keyboard()
 
 
-def cancel_button() -> VkKeyboard:
-    """Кнопка экстренного выхода из диалога с ботом"""
+def wait_buttons() -> VkKeyboard:
+    """Кнопки, пока ищутся следующие кандидаты"""
     keyboard = VkKeyboard(one_time=False)
+    keyboard.add_button("Дальше", color=VkKeyboardColor.PRIMARY)
+    keyboard.add_line()
     keyboard.add_button("Отмена", color=VkKeyboardColor.NEGATIVE)
     return keyboard.get_keyboard()
 
 
 def main() -> None:
     bot = Bot()
-    while True:
-        start = bot.start()
-        if isinstance(start, VKUser):
-            user = start
-            bot.write_msg(user.user_id, "&#128579; Похоже, что ты уже всех посмотрел. Попробуй новый поиск! &#128373;",
-                          keyboard=bot.empty_keyboard)
-        else:
-            user, values = start
-            if isinstance(values, dict):
-                results = bot.search_users(user, values)
-                if not results:
-                    bot.write_msg(user.user_id,
-                                  f'&#128530; Похоже, что в этом городе нет никого, кто отвечал бы таким '
-                                  f'условиям поиска.\nПопробуй использовать детализированный поиск или '
-                                  f'изменить условия запроса.', keyboard=bot.empty_keyboard)
-                else:
-                    bot.show_results(user, results=results)
-
-            elif isinstance(values, list):
-                bot.show_results(user, datingusers=values)
-            elif not values:
-                bot.write_msg(user.user_id,
-                              f'&#128521; Ок, давай начнём сначала.', keyboard=bot.empty_keyboard)
-
-        user.welcomed = False
+    if config.metrics_port:
+        metrics.serve(config.metrics_port)
+    if config.metrics_dump:
+        metrics.dump_every(config.metrics_dump)
+
+    if config.events == 'callback':
+        events = CallbackReceiver(config.callback_host, config.callback_port, config.callback_confirmation,
+                                  config.callback_secret).start()
+    else:
+        events = bot.longpoll
+
+    # события всех пользователей обрабатываются по мере поступления, каждое - в своём диалоге
+    try:
+        while True:
+            bot.dispatch_many(events.check())
+    finally:
+        # оценки последних секунд ещё не записаны в seen_users
+        bot.seen.flush()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,90 @@
+""" Модуль кэша с ограничением размера (вытеснение давно не использованных) и временем жизни записей."""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Tuple
+
+from metrics import metrics
+
+_MISSING = object()
+
+
+class TTLCache:
+    """ LRU-кэш на maxsize записей, каждая из которых живёт не дольше ttl секунд. Потокобезопасен.
+    sliding - срок жизни отсчитывается не от записи, а от последнего обращения к записи.
+    on_evict(key, value) вызывается для записей, вытесненных по размеру или по сроку жизни.
+    Статистика кэша с именем name отдаётся в метрики с меткой cache=name."""
+
+    def __init__(self, maxsize: int = 128, ttl: float = 600, sliding: bool = False,
+                 on_evict: Callable[[Hashable, Any], None] = None, name: str = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sliding = sliding
+        self.on_evict = on_evict
+        self.data: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.name = name
+        if name:
+            metrics.collector(self._usage)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        """Проверка наличия живой записи без учёта в статистике попаданий"""
+        with self.lock:
+            item = self.data.get(key, _MISSING)
+            return item is not _MISSING and item[0] > time.monotonic()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        evicted = []
+        with self.lock:
+            item = self.data.get(key, _MISSING)
+            if item is not _MISSING:
+                expires, value = item
+                now = time.monotonic()
+                if expires > now:
+                    if self.sliding:
+                        self.data[key] = (now + self.ttl, value)
+                    self.data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.data[key]
+                evicted.append((key, value))
+            self.misses += 1
+        self._evicted(evicted)
+        return default
+
+    def set(self, key: Hashable, value: Any) -> None:
+        evicted = []
+        with self.lock:
+            now = time.monotonic()
+            self.data[key] = (now + self.ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                evicted.append(self._pop_oldest())
+            # давно не использованные записи в начале - истёкшие убираем сразу, а не при обращении к ним
+            while self.data and next(iter(self.data.values()))[0] <= now:
+                evicted.append(self._pop_oldest())
+        self._evicted(evicted)
+
+    def _pop_oldest(self) -> Tuple[Hashable, Any]:
+        key, (_, value) = self.data.popitem(last=False)
+        return key, value
+
+    def _evicted(self, evicted: List[Tuple[Hashable, Any]]) -> None:
+        # вне блокировки: обработчик может обращаться к кэшу
+        if self.on_evict:
+            for key, value in evicted:
+                self.on_evict(key, value)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {'size': len(self.data), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0}
+
+    def _usage(self) -> List[Tuple[str, Dict[str, str], float]]:
+        return [(f'cache_{key}', {'cache': self.name}, value) for key, value in self.stats().items()]
@@ -0,0 +1,172 @@
+""" Модуль приёма событий через Callback API ВК - альтернатива longpoll.
+
+    ВК сам присылает события POST-запросами. Приёмник сразу отвечает "ok" и кладёт событие в очередь,
+    а цикл бота забирает события из неё так же, как из VkLongPoll: check() отдаёт пачку накопившихся.
+    В отличие от longpoll, такой процесс не держит единственный поток событий сообщества,
+    поэтому процессов бота может быть несколько за балансировщиком. Состояние диалогов живёт в памяти процесса,
+    так что балансировщик должен направлять события одного пользователя в один и тот же процесс.
+    Режим включается в config: VKINDER_EVENTS=callback.
+
+    Проверить приёмник можно без ВК, отправив ему записанные события (по одному JSON в строке):
+    python callback.py replay events.jsonl [http://127.0.0.1:8080/]"""
+
+import json
+import queue
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Any, List, Tuple, Optional
+
+from vk_api.longpoll import VkEventType
+
+from cache import TTLCache
+from metrics import metrics
+
+
+class CallbackEvent:
+    """Событие message_new из Callback API в том виде, в каком Bot.dispatch получает события VkLongPoll"""
+
+    __slots__ = ('type', 'to_me', 'user_id', 'text')
+
+    def __init__(self, user_id: int, text: str, to_me: bool = True):
+        self.type = VkEventType.MESSAGE_NEW
+        self.to_me = to_me
+        self.user_id = user_id
+        self.text = text
+
+    @classmethod
+    def from_update(cls, update: Dict[str, Any]) -> Optional['CallbackEvent']:
+        obj = update.get('object') or {}
+        # с версии API 5.103 сообщение вложено в object.message, в более старых object - само сообщение
+        message = obj.get('message', obj)
+        user_id = message.get('from_id') or message.get('user_id')
+        if not user_id:
+            return None
+        # боту пишут только в личные сообщения: беседы и исходящие пропускаем
+        to_me = not message.get('out') and message.get('peer_id', user_id) == user_id
+        return cls(user_id, message.get('text') or message.get('body') or '', to_me)
+
+
+class CallbackReceiver:
+    """HTTP-приёмник событий Callback API"""
+
+    # сколько последних event_id помнить, чтобы не обработать повторную доставку дважды
+    DEDUP_SIZE = 10000
+    DEDUP_TTL = 600
+
+    def __init__(self, host: str, port: int, confirmation: str, secret: str = None, wait: float = 25):
+        self.host = host
+        self.port = port
+        self.confirmation = confirmation
+        self.secret = secret
+        self.wait = wait
+        self.queue = queue.Queue()
+        self.seen = TTLCache(self.DEDUP_SIZE, self.DEDUP_TTL)
+        self.lock = threading.Lock()
+        self.server = None
+        metrics.collector(self._queue_size)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    def start(self) -> 'CallbackReceiver':
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    update = json.loads(self.rfile.read(length).decode('utf-8'))
+                except ValueError:
+                    status, body = 400, 'bad request'
+                else:
+                    status, body = receiver.handle(update)
+                body = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/plain; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='callback', daemon=True).start()
+        print(f'Принимаем события Callback API на {self.url}')
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, update: Dict[str, Any]) -> Tuple[int, str]:
+        """Ответ на одно событие. Обработка самого события - позже, в цикле бота"""
+        if self.secret and update.get('secret') != self.secret:
+            metrics.inc('callback_rejected_total')
+            return 403, 'forbidden'
+
+        kind = update.get('type')
+        metrics.inc('callback_events_total', type=kind)
+        if kind == 'confirmation':
+            return 200, self.confirmation
+
+        # ВК повторяет доставку, если не дождался "ok" - повтор уже принятого события пропускаем
+        event_id = update.get('event_id')
+        if event_id:
+            with self.lock:
+                if event_id in self.seen:
+                    metrics.inc('callback_duplicates_total')
+                    return 200, 'ok'
+                self.seen.set(event_id, True)
+
+        if kind == 'message_new':
+            event = CallbackEvent.from_update(update)
+            if event:
+                self.queue.put(event)
+        return 200, 'ok'
+
+    def check(self) -> List[CallbackEvent]:
+        """Накопившиеся события; если их нет - ожидание первого до wait секунд, как у VkLongPoll.check"""
+        try:
+            events = [self.queue.get(timeout=self.wait)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                events.append(self.queue.get_nowait())
+            except queue.Empty:
+                return events
+
+    def _queue_size(self):
+        return [('callback_queue', {}, self.queue.qsize())]
+
+
+def replay(path: str, url: str) -> None:
+    """Отправка записанных событий (JSONL) приёмнику по одному, как это делает ВК"""
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            request = urllib.request.Request(url, data=line.strip().encode('utf-8'),
+                                             headers={'Content-Type': 'application/json'})
+            started = time.perf_counter()
+            try:
+                with urllib.request.urlopen(request) as response:
+                    body = response.read().decode('utf-8')
+            except urllib.error.HTTPError as error:
+                body = f'{error.code} {error.read().decode("utf-8")}'
+            print(f'{json.loads(line).get("type")}: {body} ({(time.perf_counter() - started) * 1000:.1f} мс)')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == 'replay':
+        replay(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else 'http://127.0.0.1:8080/')
+    else:
+        print('python callback.py replay events.jsonl [url]')
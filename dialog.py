@@ -0,0 +1,45 @@
+""" Модуль диалогов бота, отвечает:
+    - хранение состояния разговора с каждым пользователем,
+    - описание шагов сценария (приветствие → пол → город → возраст → статус → сортировка → просмотр).
+
+    Бот не ждёт ответа пользователя в блокирующем вызове: каждое входящее событие направляется
+    в диалог своего пользователя, и обработчик текущего шага переводит диалог в следующее состояние."""
+
+from typing import Dict, Any, Iterator, Optional
+
+
+class DialogState:
+    """Шаги сценария диалога с пользователем"""
+    GREETING = 'greeting'
+    CONFIRM = 'confirm'
+    SEARCH_TYPE = 'search_type'
+    SEX = 'sex'
+    CITY = 'city'
+    CITY_CHOICE = 'city_choice'
+    AGE_FROM = 'age_from'
+    AGE_TO = 'age_to'
+    STATUS = 'status'
+    SORT = 'sort'
+    BROWSING = 'browsing'
+
+
+class Dialog:
+    """Состояние разговора бота с одним пользователем"""
+
+    def __init__(self, user):
+        self.user = user
+        self.reset()
+
+    def __repr__(self):
+        return f'<Dialog {self.user.user_id}: {self.state}>'
+
+    def reset(self) -> None:
+        """Возврат диалога к началу сценария"""
+        candidates = getattr(self, 'candidates', None)
+        if candidates is not None:
+            candidates.cancel()
+        self.state = DialogState.GREETING
+        self.search_values: Dict[str, Any] = {}
+        self.cities: Dict[str, int] = {}
+        self.candidates: Optional[Iterator] = None
+        self.current = None
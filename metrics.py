@@ -0,0 +1,215 @@
+""" Модуль метрик бота.
+
+    Счётчики и гистограммы задержек копятся в памяти процесса:
+    - каждый вызов API ВК (число вызовов, ожидание в планировщике, время ответа, коды ошибок по методам),
+    - каждый SQL-запрос (время по виду запроса и таблице, ошибки),
+    - ожидание свободного соединения в пуле и занятость пула.
+    Снимок отдаётся в текстовом формате Prometheus: по HTTP (serve) или периодически в поток вывода (dump_every).
+    Включаются через config: VKINDER_METRICS_PORT и VKINDER_METRICS_DUMP."""
+
+import functools
+import re
+import sys
+import threading
+import time
+from bisect import bisect_left
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, Tuple, List, Callable, Iterable, Any
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+LABELS = Tuple[Tuple[str, str], ...]
+SAMPLE = Tuple[str, Dict[str, Any], float]
+
+
+class Histogram:
+    """Распределение значений по корзинам (границы - в секундах)"""
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """Накопленные счётчики по корзинам, как их ждёт Prometheus (le - включительно)"""
+        total = 0
+        result = []
+        for bound, count in zip((*self.buckets, '+Inf'), self.counts):
+            total += count
+            result.append((str(bound), total))
+        return result
+
+
+def _labels(labels: Dict[str, Any]) -> LABELS:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format(name: str, labels: LABELS) -> str:
+    if not labels:
+        return name
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return name + '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+class Metrics:
+    """Метрики процесса"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[Tuple[str, LABELS], float] = {}
+        self.histograms: Dict[Tuple[str, LABELS], Histogram] = {}
+        self.collectors: List[Callable[[], Iterable[SAMPLE]]] = []
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, _labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, _labels(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def collector(self, func: Callable[[], Iterable[SAMPLE]]) -> Callable[[], Iterable[SAMPLE]]:
+        """Функция, возвращающая текущие значения (имя, метки, значение) - опрашивается при каждом снимке"""
+        self.collectors.append(func)
+        return func
+
+    def render(self) -> str:
+        """Снимок всех метрик в текстовом формате Prometheus"""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, histogram.cumulative(), histogram.sum, histogram.count)
+                                for key, histogram in self.histograms.items())
+        lines = []
+        typed = set()
+
+        def declare(name: str, kind: str) -> None:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), value in counters:
+            declare(name, 'counter')
+            lines.append(f'{_format(name, labels)} {value:g}')
+        for (name, labels), buckets, total, count in histograms:
+            declare(name, 'histogram')
+            for bound, cumulative in buckets:
+                lines.append(f'{_format(name + "_bucket", labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{_format(name + "_sum", labels)} {total:.6f}')
+            lines.append(f'{_format(name + "_count", labels)} {count}')
+        for collect in self.collectors:
+            try:
+                samples = list(collect())
+            except Exception as error:
+                print(f'Не удалось собрать метрики {collect.__name__}: {error!r}')
+                continue
+            for name, labels, value in samples:
+                declare(name, 'gauge')
+                lines.append(f'{_format(name, _labels(labels))} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int, host: str = '0.0.0.0') -> ThreadingHTTPServer:
+        """HTTP-сервер в фоновом потоке, отдающий снимок метрик по GET /metrics"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        return server
+
+    def dump_every(self, interval: float, stream=None) -> threading.Thread:
+        """Печать снимка метрик раз в interval секунд (по умолчанию - в stderr)"""
+
+        def run():
+            while True:
+                time.sleep(interval)
+                print(self.render(), file=stream or sys.stderr, flush=True)
+
+        thread = threading.Thread(target=run, name='metrics-dump', daemon=True)
+        thread.start()
+        return thread
+
+
+metrics = Metrics()
+
+# после какого слова в запросе стоит имя таблицы
+_TABLE_AFTER = {'SELECT': 'FROM', 'DELETE': 'FROM', 'INSERT': 'INTO', 'UPDATE': 'UPDATE', 'COPY': 'COPY'}
+
+
+@functools.lru_cache(maxsize=1024)
+def statement_label(statement: str) -> str:
+    """Вид запроса и первая таблица ("SELECT datinguser") - метка без параметров, чтобы число рядов было конечным"""
+    words = statement.split(None, 1)
+    if not words:
+        return ''
+    verb = words[0].upper()
+    anchor = _TABLE_AFTER.get(verb)
+    match = anchor and re.search(rf'\b{anchor}\s+"?(\w+)', statement, re.IGNORECASE)
+    return f'{verb} {match.group(1)}' if match else verb
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool, замеряющий ожидание соединения: и свободного из пула, и нового"""
+
+    def connect(self):
+        started = time.monotonic()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            metrics.inc('db_pool_timeouts_total')
+            raise
+        finally:
+            metrics.observe('db_pool_wait_seconds', time.monotonic() - started)
+
+
+def instrument_engine(engine) -> None:
+    """Замер времени каждого SQL-запроса движка, счёт ошибок и занятость пула"""
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_started', []).append(time.monotonic())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['metrics_started'].pop()
+        metrics.observe('db_statement_seconds', time.monotonic() - started, statement=statement_label(statement))
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        metrics.inc('db_errors_total', statement=statement_label(context.statement or ''),
+                    error=type(context.original_exception).__name__)
+        if context.connection is not None and context.connection.info.get('metrics_started'):
+            context.connection.info['metrics_started'].pop()
+
+    @metrics.collector
+    def pool_usage():
+        pool = engine.pool
+        return [('db_pool_checked_out', {}, pool.checkedout()), ('db_pool_overflow', {}, pool.overflow())]
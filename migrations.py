@@ -0,0 +1,89 @@
+""" Модуль версионных миграций схемы БД.
+
+    Base.metadata.create_all создаёт только отсутствующие таблицы и не трогает существующие,
+    поэтому изменения схемы уже работающих баз (индексы и т.п.) описываются здесь по версиям.
+    Номер применённой версии хранится в таблице schema_version.
+
+    python migrations.py             - обновить базу до последней версии
+    python migrations.py downgrade 1 - откатить базу до версии 1"""
+
+import sys
+from datetime import datetime
+from typing import List, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+# (версия, описание, SQL для обновления, SQL для отката)
+MIGRATIONS: List[Tuple[int, str, List[str], List[str]]] = [
+    (1, 'Индекс для поиска города по началу названия', [
+        'CREATE INDEX IF NOT EXISTS ix_city_title_prefix ON city (lower(title) text_pattern_ops)',
+    ], [
+        'DROP INDEX IF EXISTS ix_city_title_prefix',
+    ]),
+    (2, 'Индексы горячих запросов к query и datinguser', [
+        'CREATE INDEX IF NOT EXISTS ix_query_user_datetime ON query (user_id, datetime DESC)',
+        'CREATE INDEX IF NOT EXISTS ix_datinguser_query_viewed ON datinguser (query_id, viewed)',
+        'CREATE INDEX IF NOT EXISTS ix_datinguser_vk_query ON datinguser (vk_id, query_id)',
+        'CREATE INDEX IF NOT EXISTS ix_datinguser_query_black_list ON datinguser (query_id, black_list) '
+        'WHERE black_list IS NOT NULL',
+    ], [
+        'DROP INDEX IF EXISTS ix_query_user_datetime',
+        'DROP INDEX IF EXISTS ix_datinguser_query_viewed',
+        'DROP INDEX IF EXISTS ix_datinguser_vk_query',
+        'DROP INDEX IF EXISTS ix_datinguser_query_black_list',
+    ]),
+    (3, 'Таблица просмотренных юзеров', [
+        'CREATE TABLE IF NOT EXISTS seen_users '
+        '(user_id INTEGER PRIMARY KEY REFERENCES "user" (id), vk_ids BYTEA NOT NULL)',
+    ], [
+        'DROP TABLE IF EXISTS seen_users',
+    ]),
+]
+
+
+def current_version(engine: Engine) -> int:
+    with engine.begin() as conn:
+        conn.execute(text('CREATE TABLE IF NOT EXISTS schema_version '
+                          '(version INTEGER PRIMARY KEY, applied_at TIMESTAMP NOT NULL)'))
+        return conn.execute(text('SELECT coalesce(max(version), 0) FROM schema_version')).scalar()
+
+
+def upgrade(engine: Engine, to: int = None) -> int:
+    """Применение всех ещё не применённых миграций (до версии to включительно). Каждая - в своей транзакции."""
+    version = current_version(engine)
+    for number, title, up, _ in MIGRATIONS:
+        if number <= version or (to is not None and number > to):
+            continue
+        print(f'Миграция {number}: {title}')
+        with engine.begin() as conn:
+            for statement in up:
+                conn.execute(text(statement))
+            conn.execute(text('INSERT INTO schema_version (version, applied_at) VALUES (:version, :now)'),
+                         version=number, now=datetime.utcnow())
+        version = number
+    return version
+
+
+def downgrade(engine: Engine, to: int) -> int:
+    """Откат миграций новее версии to"""
+    version = current_version(engine)
+    for number, title, _, down in reversed(MIGRATIONS):
+        if number > version or number <= to:
+            continue
+        print(f'Откат миграции {number}: {title}')
+        with engine.begin() as conn:
+            for statement in down:
+                conn.execute(text(statement))
+            conn.execute(text('DELETE FROM schema_version WHERE version = :version'), version=number)
+        version = number - 1
+    return version
+
+
+if __name__ == '__main__':
+    from database import Connect
+
+    if len(sys.argv) > 2 and sys.argv[1] == 'downgrade':
+        print(f'Версия схемы: {downgrade(Connect.engine, int(sys.argv[2]))}')
+    else:
+        print(f'Версия схемы: {upgrade(Connect.engine)}')
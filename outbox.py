@@ -0,0 +1,161 @@
+""" Модуль исходящих сообщений бота.
+
+    write_msg не отправляет сообщение сам, а ставит его в очередь своего получателя:
+    - отправкой занимаются фоновые потоки, диалоги не ждут ответа messages.send,
+    - сообщения одному получателю уходят строго по порядку, разные получатели обслуживаются по кругу,
+    - соседние сообщения одному получателю склеиваются в одно, если это не меняет того, что он увидит,
+    - частоту отправки ограничивает общий планировщик запросов к API (лимит токена сообщества),
+    - у каждого потока отправки своя сессия API с тем же токеном, чтобы отправки не ждали друг друга."""
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Any, List, Tuple
+
+import tracing
+from metrics import metrics
+
+MESSAGE = Dict[str, Any]
+
+# сообщения, накопленные за текущий шаг диалога (см. Outbox.step)
+_held: ContextVar = ContextVar('outbox_held', default=None)
+
+
+def can_merge(first: MESSAGE, second: MESSAGE) -> bool:
+    """Можно ли отправить два сообщения одному получателю одним"""
+    if first['user_id'] != second['user_id']:
+        return False
+    if len(first['message']) + len(second['message']) + 1 > Outbox.MAX_LENGTH:
+        return False
+    attachments = [value for value in (first.get('attachment'), second.get('attachment')) if value]
+    return sum(len(value.split(',')) for value in attachments) <= Outbox.MAX_ATTACHMENTS
+
+
+def merge(first: MESSAGE, second: MESSAGE) -> MESSAGE:
+    merged = {**first, 'message': first['message'].rstrip(' ') + '\n' + second['message']}
+    attachments = [value for value in (first.get('attachment'), second.get('attachment')) if value]
+    if attachments:
+        merged['attachment'] = ','.join(attachments)
+    # клавиатура в ВК остаётся до следующей, поэтому у склеенного сообщения - последняя из отправленных
+    if second.get('keyboard'):
+        merged['keyboard'] = second['keyboard']
+    return merged
+
+
+class Outbox:
+    """Очереди исходящих сообщений по получателям"""
+
+    MAX_LENGTH = 4096
+    MAX_ATTACHMENTS = 10
+
+    def __init__(self, vk_bot, workers: int = 4):
+        self.vk_bot = vk_bot
+        self.workers = workers
+        self.threads: List[threading.Thread] = []
+        self.queues: Dict[int, deque] = {}
+        self.ready = deque()
+        self.cond = threading.Condition()
+        self.sent = 0
+        self.merged = 0
+        metrics.collector(self._usage)
+
+    @contextmanager
+    def step(self):
+        """Сообщения, отправленные внутри блока, ставятся в очереди разом на выходе из него,
+        чтобы сообщения одного шага диалога одному получателю склеились"""
+        if _held.get() is not None:
+            yield
+            return
+        token = _held.set([])
+        try:
+            yield
+        finally:
+            messages = _held.get()
+            _held.reset(token)
+            self._enqueue(messages)
+
+    def send(self, values: MESSAGE) -> None:
+        # сообщение относится к трассе шага, в котором отправлено: она закроется только после его отправки
+        item = (values, tracing.current_trace())
+        held = _held.get()
+        if held is not None:
+            held.append(item)
+        else:
+            self._enqueue([item])
+
+    def _enqueue(self, messages: List[Tuple[MESSAGE, Any]]) -> None:
+        if not messages:
+            return
+        self._start()
+        enqueued = time.monotonic()
+        with self.cond:
+            for values, trace in messages:
+                if trace:
+                    trace.hold()
+                peer = values['user_id']
+                if peer not in self.queues:
+                    # получатель без очереди - ни в ожидании, ни в отправке: ставим его в круг
+                    self.queues[peer] = deque()
+                    self.ready.append(peer)
+                self.queues[peer].append((values, trace, enqueued))
+            self.cond.notify_all()
+
+    def _start(self) -> None:
+        with self.cond:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self._run, args=(self.vk_bot.copy(),),
+                                          name=f'outbox-{len(self.threads)}', daemon=True)
+                self.threads.append(thread)
+                thread.start()
+
+    def _run(self, vk_bot) -> None:
+        while True:
+            with self.cond:
+                while not self.ready:
+                    self.cond.wait()
+                peer = self.ready.popleft()
+                queue = self.queues[peer]
+                values, trace, enqueued = queue.popleft()
+                # трасса -> когда её первое сообщение встало в очередь и сколько её сообщений в этой отправке
+                traces = {trace: [enqueued, 1]} if trace else {}
+                while queue and can_merge(values, queue[0][0]):
+                    next_values, trace, enqueued = queue.popleft()
+                    values = merge(values, next_values)
+                    if trace:
+                        traces.setdefault(trace, [enqueued, 0])[1] += 1
+                    self.merged += 1
+
+            # в трассы шагов попадает время ожидания в очереди и сама отправка
+            sending = time.monotonic()
+            for trace, (enqueued, _) in traces.items():
+                trace.record('outbox', enqueued, sending, peer=peer)
+            try:
+                with tracing.attach(next(iter(traces), None)):
+                    vk_bot.method('messages.send', values)
+                self.sent += 1
+            except Exception as error:
+                print(f'Не удалось отправить сообщение пользователю {peer}: {error!r}')
+            finally:
+                sent = time.monotonic()
+                for number, (trace, (_, messages)) in enumerate(traces.items()):
+                    if number:
+                        trace.record('vk messages.send', sending, sent)
+                    for _ in range(messages):
+                        trace.release()
+
+            with self.cond:
+                if queue:
+                    self.ready.append(peer)
+                    self.cond.notify()
+                else:
+                    del self.queues[peer]
+
+    def stats(self) -> Dict[str, int]:
+        with self.cond:
+            return {'sent': self.sent, 'merged': self.merged, 'peers': len(self.queues),
+                    'queued': sum(len(queue) for queue in self.queues.values())}
+
+    def _usage(self) -> List[Tuple[str, Dict[str, str], int]]:
+        return [(f'outbox_{key}', {}, value) for key, value in self.stats().items()]
@@ -0,0 +1,77 @@
+""" Модуль фоновой подгрузки фотографий кандидатов.
+
+    Пока пользователь смотрит на текущего кандидата, топ-3 фото следующих кандидатов
+    уже запрашиваются через фоновый сборщик execute, поэтому следующий профиль показывается без ожидания photos.get.
+    Если фото ещё не пришли к моменту показа, их запрос повышается до приоритета диалога.
+    Кандидатов потокового поиска очередь не ждёт: если следующий ещё не найден, диалог узнаёт об этом
+    из исключения StillSearching и может ответить пользователю сразу."""
+
+from collections import deque
+from typing import Iterable
+
+import tracing
+from vk_scope import VKAuth
+
+
+class StillSearching(Exception):
+    """Следующий кандидат ещё не найден, но поиск продолжается"""
+
+
+class PhotoQueue:
+    """Очередь кандидатов с заранее запрошенными фотографиями"""
+
+    def __init__(self, candidates: Iterable, depth: int = 3):
+        # потоковый поиск отдаёт кандидатов через poll() без ожидания, остальные источники - обычные итераторы
+        self.candidates = candidates if hasattr(candidates, 'poll') else iter(candidates)
+        self.depth = depth
+        self.pending = deque()
+        self._fill()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.pending:
+            self._fill()
+        if not self.pending:
+            # источник может быть исчерпан или ещё искать - во втором случае диалог не ждёт его
+            if getattr(self.candidates, 'exhausted', True):
+                raise StopIteration
+            raise StillSearching
+        d_user, future = self.pending.popleft()
+        # следующего кандидата ставим в очередь до того, как ждать фото текущего
+        self._fill()
+        try:
+            with tracing.span('photos', vk_id=d_user.id):
+                # диалог ждёт эти фото: дальше их запрос не должен уступать фоновым
+                VKAuth.batcher.promote(future)
+                d_user.photos = d_user.top_photos(future.result())
+        except Exception as error:
+            print(f'Не удалось получить фото юзера {d_user.id}: {error!r}')
+            d_user.photos = []
+        return d_user
+
+    def _take(self):
+        """Следующий кандидат или None. У потокового поиска берём только уже найденных"""
+        poll = getattr(self.candidates, 'poll', None)
+        if poll is None:
+            return next(self.candidates, None)
+        return poll()
+
+    def _fill(self) -> None:
+        while len(self.pending) < self.depth:
+            d_user = self._take()
+            if d_user is None:
+                return
+            self.pending.append((d_user, d_user.request_photo()))
+
+    def cancel(self) -> None:
+        """Отмена ещё не начатых запросов фото, например когда пользователь нажал "Отмена" """
+        for _, future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        # источник кандидатов может сам уметь останавливаться (например, потоковый поиск)
+        cancel = getattr(self.candidates, 'cancel', None)
+        if cancel:
+            cancel()
+        self.candidates = iter(())
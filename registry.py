@@ -0,0 +1,55 @@
+""" Модуль реестра активных пользователей бота.
+
+    Профили пользователей (VKUser) и их диалоги хранятся ограниченное время и в ограниченном количестве:
+    давно не писавшие вытесняются, а при следующем сообщении профиль загружается заново.
+    Срок хранения отсчитывается от последнего сообщения пользователя, а у вытесненного диалога
+    останавливаются поиск и подгрузка фото его кандидатов.
+    Профили всех новых собеседников из одной пачки событий longpoll запрашиваются одним вызовом users.get."""
+
+from typing import Iterable
+
+from cache import TTLCache
+from dialog import Dialog
+from vk_scope import VKUser
+
+
+class UserRegistry:
+    """Профили и диалоги активных пользователей"""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 3600):
+        self.users = TTLCache(maxsize, ttl, sliding=True, name='users')
+        self.dialogs = TTLCache(maxsize, ttl, sliding=True, on_evict=self._evicted, name='dialogs')
+
+    def __len__(self):
+        return len(self.users)
+
+    def prefetch(self, user_ids: Iterable[int]) -> None:
+        """Загрузка профилей всех ещё неизвестных пользователей одним запросом"""
+        missing = [user_id for user_id in set(user_ids) if user_id not in self.users]
+        for user_id, user in VKUser.get_many(missing).items():
+            self.users.set(user_id, user)
+
+    def get_user(self, user_id: int) -> VKUser:
+        user = self.users.get(user_id)
+        if user is None:
+            user = VKUser(user_id)
+            self.users.set(user_id, user)
+        return user
+
+    def get_dialog(self, user: VKUser) -> Dialog:
+        dialog = self.dialogs.get(user.user_id)
+        # диалог вытесненного и заново загруженного пользователя начинается сначала
+        if dialog is None or dialog.user is not user:
+            if dialog is not None:
+                self._evicted(user.user_id, dialog)
+            dialog = Dialog(user)
+            self.dialogs.set(user.user_id, dialog)
+        return dialog
+
+    def find_dialog(self, user_id: int) -> Dialog or None:
+        return self.dialogs.get(user_id)
+
+    @staticmethod
+    def _evicted(user_id: int, dialog: Dialog) -> None:
+        if dialog.candidates is not None:
+            dialog.candidates.cancel()
@@ -0,0 +1,118 @@
+""" Модуль потокового поиска.
+
+    users.search отдаёт не больше 1000 человек на запрос. Если по условиям пользователя найдено больше,
+    запрос дробится на окна по возрасту (а слишком большие окна - ещё и по месяцу рождения),
+    окна обходятся в фоне, а найденные кандидаты записываются в БД и становятся доступны для показа
+    сразу, не дожидаясь конца поиска. Первая страница результатов показывается, пока ищутся остальные.
+    Окна обходятся не впрок, а по мере того, как пользователь досматривает уже найденных."""
+
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Iterator, List
+
+from vk_scheduler import background
+
+
+class SearchStream:
+    """Кандидаты одного поиска в порядке их нахождения"""
+
+    PAGE_SIZE = 1000
+
+    # обход окон приостанавливается, когда непоказанных кандидатов набирается столько, и продолжается,
+    # когда пользователь их досматривает: брошенный поиск не обходит окна до конца и не копит кандидатов без счёта
+    BUFFER = 100
+
+    def __init__(self, bot, vk_user, search_values: Dict[str, Any], query_id: int, total: int):
+        self.bot = bot
+        self.vk_user = vk_user
+        self.search_values = search_values
+        self.query_id = query_id
+        self.total = total
+        self.ingested = set()
+        self.buffer = deque()
+        self.lock = threading.Lock()
+        self.pages = self._pages()
+        self.executor = None
+        self.crawling = False
+        self.finished = False
+        self.cancelled = threading.Event()
+
+    def poll(self):
+        """Следующий уже найденный кандидат без ожидания или None. Если запас кончается - обход окон продолжается"""
+        with self.lock:
+            item = self.buffer.popleft() if self.buffer else None
+            self._resume()
+        return item
+
+    @property
+    def exhausted(self) -> bool:
+        """Поиск закончен (или отменён), и все найденные кандидаты уже отданы"""
+        with self.lock:
+            return (self.finished or self.cancelled.is_set()) and not self.buffer
+
+    def put(self, candidates: List) -> None:
+        with self.lock:
+            self.buffer.extend(candidates)
+
+    def start(self, executor: ThreadPoolExecutor) -> None:
+        """Запуск обхода остальных окон поиска, если первая страница вместила не всех"""
+        with self.lock:
+            self.executor = executor
+            if self.total > self.PAGE_SIZE:
+                self._resume()
+            else:
+                self.finished = True
+
+    def _resume(self) -> None:
+        """Продолжение обхода окон, если запас кандидатов ниже BUFFER. Вызывается под self.lock"""
+        if self.crawling or self.finished or self.cancelled.is_set() or len(self.buffer) >= self.BUFFER:
+            return
+        self.crawling = True
+        self.executor.submit(self._crawl)
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+        with self.lock:
+            self.buffer.clear()
+
+    def windows(self) -> Iterator[Dict[str, Any]]:
+        """Окна поиска: по одному году возраста"""
+        for age in range(self.search_values['age_from'], self.search_values['age_to'] + 1):
+            yield {'age_from': age, 'age_to': age}
+
+    def _pages(self) -> Iterator[List[Dict[str, Any]]]:
+        for window in self.windows():
+            if self.cancelled.is_set():
+                return
+            values = {**self.search_values, **window}
+            total, items = self.bot.search_page(values, cache=False)
+            if total <= self.PAGE_SIZE:
+                yield items
+                continue
+            # в одном возрасте больше 1000 человек - дробим ещё и по месяцу рождения
+            for month in range(1, 13):
+                if self.cancelled.is_set():
+                    return
+                yield self.bot.search_page({**values, 'birth_month': month}, cache=False)[1]
+
+    @background
+    def _crawl(self) -> None:
+        """Обход следующих окон, пока в запасе меньше BUFFER кандидатов. Поток пула при паузе освобождается"""
+        try:
+            while True:
+                with self.lock:
+                    if self.cancelled.is_set() or len(self.buffer) >= self.BUFFER:
+                        self.crawling = False
+                        return
+                items = next(self.pages, None)
+                if items is None:
+                    break
+                with self.bot.unit_of_work():
+                    self.put(self.bot.ingest(self.vk_user, self.query_id, self.search_values['city'], items,
+                                             self.ingested))
+        except Exception as error:
+            print(f'Ошибка потокового поиска для пользователя {self.vk_user.user_id}: {error!r}')
+        with self.lock:
+            self.crawling = False
+            self.finished = True
@@ -0,0 +1,164 @@
+""" Модуль учёта уже просмотренных юзеров.
+
+    Для каждого пользователя хранится отсортированный массив vk_id всех, кого он уже оценил
+    (лайкнул или отправил в чёрный список). Массив читается из БД один раз, пополняется при каждой оценке
+    и хранится в таблице seen_users в сжатом виде, поэтому отсев уже просмотренных из 1000 свежих
+    результатов поиска - один проход по памяти вместо запроса к БД на каждого кандидата.
+    Оценки пишутся в seen_users не по одной, а раз в несколько секунд одним запросом за всех пользователей.
+    Сами оценки сразу сохраняются в datinguser, а при аварийном завершении в seen_users не попадут только
+    последние секунды: такие кандидаты могут встретиться пользователю повторно."""
+
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+from typing import Iterable, List, Dict
+
+from cache import TTLCache
+from database import Connect, DatingUser, Query, SeenUsers
+
+
+class SeenSet:
+    """Отсортированный массив vk_id без повторов"""
+
+    __slots__ = ('ids',)
+
+    def __init__(self, ids: Iterable[int] = ()):
+        self.ids = array('q', sorted(set(ids)))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, vk_id: int) -> bool:
+        index = bisect_left(self.ids, vk_id)
+        return index < len(self.ids) and self.ids[index] == vk_id
+
+    def add(self, vk_id: int) -> bool:
+        """Добавление vk_id. Возвращает False, если он уже был"""
+        index = bisect_left(self.ids, vk_id)
+        if index < len(self.ids) and self.ids[index] == vk_id:
+            return False
+        self.ids.insert(index, vk_id)
+        return True
+
+    def intersection(self, vk_ids: Iterable[int]) -> List[int]:
+        """Какие из переданных vk_id уже просмотрены: слиянием двух отсортированных последовательностей"""
+        found = []
+        ids = self.ids
+        i, size = 0, len(ids)
+        for vk_id in sorted(vk_ids):
+            while i < size and ids[i] < vk_id:
+                i += 1
+            if i == size:
+                break
+            if ids[i] == vk_id:
+                found.append(vk_id)
+        return found
+
+    def to_bytes(self) -> bytes:
+        """Компактное представление: разности соседних id, сжатые zlib"""
+        deltas = array('q', (b - a for a, b in zip([0, *self.ids], self.ids)))
+        return zlib.compress(deltas.tobytes())
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'SeenSet':
+        deltas = array('q')
+        deltas.frombytes(zlib.decompress(data))
+        seen = cls()
+        seen.ids = array('q', accumulate(deltas))
+        return seen
+
+
+class SeenIndex(Connect):
+    """Множества просмотренных юзеров по пользователям бота"""
+
+    # не чаще чем раз в столько секунд изменённые множества записываются в seen_users
+    FLUSH_INTERVAL = 5
+
+    # сколько блокировок на загрузку множеств: пользователю соответствует одна из них
+    LOCKS = 64
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 3600):
+        # множества давно не заходивших пользователей вытесняются, в seen_users они сохранены
+        self.sets = TTLCache(maxsize, ttl)
+        # изменённые, но ещё не записанные множества - держим их и после вытеснения из sets,
+        # а те, что записываются прямо сейчас, - до коммита записи
+        self.dirty: Dict[int, SeenSet] = {}
+        self.saving: Dict[int, SeenSet] = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.locks = [threading.Lock() for _ in range(self.LOCKS)]
+        self.flusher = None
+
+    def get(self, user_id: int) -> SeenSet:
+        """Множество пользователя: из памяти, из seen_users или (один раз) собранное по datinguser"""
+        seen = self.sets.get(user_id)
+        if seen is not None:
+            return seen
+
+        # диалог и дочитывающий поиск могут запросить множество одновременно - загружается оно один раз
+        with self.locks[user_id % self.LOCKS]:
+            seen = self.sets.get(user_id)
+            if seen is not None:
+                return seen
+            with self.lock:
+                seen = self.dirty.get(user_id, self.saving.get(user_id))
+            if seen is None:
+                seen = self._load(user_id)
+            self.sets.set(user_id, seen)
+        return seen
+
+    def _load(self, user_id: int) -> SeenSet:
+        row = self.select_from_db(SeenUsers.vk_ids, SeenUsers.user_id == user_id).first()
+        if row:
+            return SeenSet.from_bytes(row[0])
+        viewed = self.select_from_db(DatingUser.vk_id, (Query.user_id == user_id, DatingUser.viewed.is_(True)),
+                                     join=Query)
+        seen = SeenSet(vk_id for vk_id, in viewed)
+        self._changed(user_id, seen)
+        return seen
+
+    def add(self, user_id: int, vk_id: int) -> None:
+        """Учёт оценки пользователя"""
+        seen = self.get(user_id)
+        if seen.add(vk_id):
+            self._changed(user_id, seen)
+
+    def _changed(self, user_id: int, seen: SeenSet) -> None:
+        with self.lock:
+            self.dirty[user_id] = seen
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self._run, name='seen-flush', daemon=True)
+                self.flusher.start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as error:
+                print(f'Не удалось сохранить просмотренных юзеров: {error!r}')
+
+    def flush(self) -> None:
+        """Запись всех изменённых множеств одним INSERT ... ON CONFLICT"""
+        with self.flush_lock:
+            with self.lock:
+                self.saving, self.dirty = self.dirty, {}
+            if not self.saving:
+                return
+            rows = [{'user_id': user_id, 'vk_ids': seen.to_bytes()} for user_id, seen in sorted(self.saving.items())]
+            try:
+                with self.unit_of_work():
+                    self.upsert_to_db(SeenUsers, rows)
+            except Exception:
+                # не записанные множества запишутся в следующий раз, если их не успели изменить ещё раз
+                with self.lock:
+                    for user_id, seen in self.saving.items():
+                        self.dirty.setdefault(user_id, seen)
+                raise
+            finally:
+                # до коммита get() берёт вытесненные множества из saving, а не из seen_users без последних оценок
+                with self.lock:
+                    self.saving = {}
@@ -0,0 +1,74 @@
+""" Тесты кэша с вытеснением по размеру и времени жизни (cache.TTLCache)."""
+
+from types import SimpleNamespace
+
+import pytest
+
+import cache
+from cache import TTLCache
+from metrics import Metrics
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(cache, 'time', SimpleNamespace(monotonic=lambda: now.value))
+    return now
+
+
+def test_lru_eviction():
+    evicted = []
+    items = TTLCache(2, 60, on_evict=lambda key, value: evicted.append((key, value)))
+    items.set('a', 1)
+    items.set('b', 2)
+    assert items.get('a') == 1
+    items.set('c', 3)
+    assert evicted == [('b', 2)]
+    assert items.get('b') is None
+    assert items.get('a') == 1 and items.get('c') == 3
+
+
+def test_ttl_expiry(clock):
+    evicted = []
+    items = TTLCache(10, 60, on_evict=lambda key, value: evicted.append(key))
+    items.set('a', 1)
+    clock.value += 30
+    assert items.get('a') == 1
+    clock.value += 31
+    assert 'a' not in items
+    assert items.get('a') is None
+    assert evicted == ['a']
+    assert items.stats()['misses'] == 1
+
+
+def test_sliding_expiry(clock):
+    items = TTLCache(10, 60, sliding=True)
+    items.set('a', 1)
+    for _ in range(5):
+        clock.value += 50
+        assert items.get('a') == 1
+    clock.value += 61
+    assert items.get('a') is None
+
+
+def test_set_drops_expired_entries(clock):
+    evicted = []
+    items = TTLCache(10, 60, on_evict=lambda key, value: evicted.append(key))
+    items.set('a', 1)
+    items.set('b', 2)
+    clock.value += 61
+    items.set('c', 3)
+    assert evicted == ['a', 'b']
+    assert len(items) == 1
+
+
+def test_named_cache_metrics():
+    collected = Metrics()
+    items = TTLCache(10, 60, name='test')
+    collected.collector(items._usage)
+    items.set('a', 1)
+    items.get('a')
+    items.get('b')
+    text = collected.render()
+    assert 'cache_hits{cache="test"} 1' in text
+    assert 'cache_hit_rate{cache="test"} 0.5' in text
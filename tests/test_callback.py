@@ -0,0 +1,45 @@
+""" Тесты приёмника событий Callback API (callback.CallbackReceiver.handle)."""
+
+from callback import CallbackReceiver
+
+
+def receiver(secret=None):
+    return CallbackReceiver('127.0.0.1', 0, confirmation='a1b2c3', secret=secret, wait=0)
+
+
+def message_new(event_id, user_id=42, text='Привет', secret=None):
+    update = {'type': 'message_new', 'event_id': event_id,
+              'object': {'message': {'from_id': user_id, 'peer_id': user_id, 'text': text}}}
+    if secret:
+        update['secret'] = secret
+    return update
+
+
+def test_confirmation():
+    assert receiver().handle({'type': 'confirmation', 'group_id': 1}) == (200, 'a1b2c3')
+
+
+def test_secret():
+    callback = receiver(secret='s3cret')
+    assert callback.handle(message_new('e1')) == (403, 'forbidden')
+    assert callback.handle(message_new('e1', secret='wrong')) == (403, 'forbidden')
+    assert callback.check() == []
+    assert callback.handle(message_new('e1', secret='s3cret')) == (200, 'ok')
+    [event] = callback.check()
+    assert (event.user_id, event.text, event.to_me) == (42, 'Привет', True)
+
+
+def test_duplicate_delivery():
+    callback = receiver()
+    assert callback.handle(message_new('e1')) == (200, 'ok')
+    assert callback.handle(message_new('e1')) == (200, 'ok')
+    assert callback.handle(message_new('e2', text='Да')) == (200, 'ok')
+    assert [event.text for event in callback.check()] == ['Привет', 'Да']
+
+
+def test_outgoing_and_chat_messages_are_not_to_me():
+    callback = receiver()
+    callback.handle({'type': 'message_new', 'event_id': 'e3',
+                     'object': {'message': {'from_id': 42, 'peer_id': 2000000001, 'text': 'всем'}}})
+    [event] = callback.check()
+    assert not event.to_me
@@ -0,0 +1,68 @@
+""" Тесты потокового чтения фикстур (database.iter_fixture) на маленьких кусках:
+значения, пробелы и разделители должны оказываться на границах кусков."""
+
+import json
+
+import pytest
+
+from database import iter_fixture
+
+ROWS = [
+    {'model': 'city', 'fields': {'id': 1, 'title': 'Москва', 'area': None, 'important': True}},
+    {'model': 'city', 'fields': {'id': 123456, 'title': 'Нью-Йорк, "Big Apple"', 'area': 'штат'}},
+    [123456, 7, -0.5, 1e3, False, None],
+    'строка с \\"экранированием\\" и ]скобкой,',
+    123456,
+    7,
+    True,
+    None,
+]
+
+
+def write(tmp_path, text: str, name: str = 'fixture.json') -> str:
+    path = tmp_path / name
+    path.write_text(text, encoding='utf-8')
+    return str(path)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 5, 7, 64])
+@pytest.mark.parametrize('indent', [None, 2])
+def test_values_split_between_chunks(tmp_path, chunk_size, indent):
+    path = write(tmp_path, json.dumps(ROWS, ensure_ascii=False, indent=indent))
+    assert list(iter_fixture(path, chunk_size)) == ROWS
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 4])
+def test_number_cut_at_chunk_end(tmp_path, chunk_size):
+    path = write(tmp_path, '[123456, 7]')
+    assert list(iter_fixture(path, chunk_size)) == [123456, 7]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 8])
+def test_leading_whitespace_longer_than_chunk(tmp_path, chunk_size):
+    path = write(tmp_path, ' \n\t' * 10 + '[1, 2]')
+    assert list(iter_fixture(path, chunk_size)) == [1, 2]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3])
+@pytest.mark.parametrize('text', ['[]', ' [ ] ', '[\n]\n'])
+def test_empty_array(tmp_path, chunk_size, text):
+    assert list(iter_fixture(write(tmp_path, text), chunk_size)) == []
+
+
+@pytest.mark.parametrize('text', ['', '   ', '{"a": 1}'])
+def test_not_an_array(tmp_path, text):
+    with pytest.raises(ValueError):
+        list(iter_fixture(write(tmp_path, text), 3))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 64])
+@pytest.mark.parametrize('text', ['[1, 2', '[1, {"a": ', '[1 2]'])
+def test_malformed_array(tmp_path, chunk_size, text):
+    with pytest.raises(ValueError):
+        list(iter_fixture(write(tmp_path, text), chunk_size))
+
+
+def test_jsonl(tmp_path):
+    text = '\n'.join(json.dumps(row, ensure_ascii=False) for row in ROWS) + '\n\n'
+    assert list(iter_fixture(write(tmp_path, text, 'fixture.jsonl'), 3)) == ROWS
@@ -0,0 +1,39 @@
+""" Тесты склейки исходящих сообщений (outbox.can_merge, outbox.merge)."""
+
+from outbox import Outbox, can_merge, merge
+
+
+def message(text, user_id=1, **values):
+    return {'user_id': user_id, 'message': text, **values}
+
+
+def test_merge_text_and_keyboard():
+    merged = merge(message('Привет ', keyboard='first'), message('Как дела?', keyboard='second'))
+    assert merged['message'] == 'Привет\nКак дела?'
+    assert merged['keyboard'] == 'second'
+
+
+def test_merge_keeps_first_keyboard_if_second_has_none():
+    assert merge(message('a', keyboard='first'), message('b'))['keyboard'] == 'first'
+
+
+def test_merge_attachments():
+    merged = merge(message('a', attachment='photo1_1,photo1_2'), message('b', attachment='photo1_3'))
+    assert merged['attachment'] == 'photo1_1,photo1_2,photo1_3'
+    assert 'attachment' not in merge(message('a'), message('b'))
+
+
+def test_cannot_merge_different_peers():
+    assert not can_merge(message('a', user_id=1), message('b', user_id=2))
+
+
+def test_length_limit():
+    half = (Outbox.MAX_LENGTH - 1) // 2
+    assert can_merge(message('a' * half), message('b' * half))
+    assert not can_merge(message('a' * half), message('b' * (half + 2)))
+
+
+def test_attachment_limit():
+    first = message('a', attachment=','.join(f'photo1_{i}' for i in range(Outbox.MAX_ATTACHMENTS - 1)))
+    assert can_merge(first, message('b', attachment='photo1_100'))
+    assert not can_merge(first, message('b', attachment='photo1_100,photo1_101'))
@@ -0,0 +1,85 @@
+""" Тесты учёта просмотренных юзеров (seen.py): сжатое представление множества и запись изменений пачками."""
+
+from contextlib import contextmanager
+
+import pytest
+
+from seen import SeenSet, SeenIndex
+
+
+@pytest.mark.parametrize('ids', [[], [5], [3, 1, 2, 2], [10 ** 12, 1, 500000, 7], list(range(0, 100000, 7))])
+def test_round_trip(ids):
+    seen = SeenSet.from_bytes(SeenSet(ids).to_bytes())
+    assert list(seen.ids) == sorted(set(ids))
+
+
+def test_add_contains_intersection():
+    seen = SeenSet([30, 10])
+    assert seen.add(20)
+    assert not seen.add(10)
+    assert list(seen.ids) == [10, 20, 30]
+    assert 20 in seen and 25 not in seen
+    assert seen.intersection([40, 30, 5, 10]) == [10, 30]
+
+
+class MemoryIndex(SeenIndex):
+    """SeenIndex, у которого seen_users - словарь в памяти"""
+
+    def __init__(self):
+        super().__init__(maxsize=10, ttl=60)
+        self.table = {}
+        self.during_upsert = None
+
+    def _load(self, user_id):
+        return SeenSet.from_bytes(self.table[user_id]) if user_id in self.table else SeenSet()
+
+    @contextmanager
+    def unit_of_work(self):
+        yield
+
+    def upsert_to_db(self, model, rows):
+        if self.during_upsert:
+            self.during_upsert()
+        for row in rows:
+            self.table[row['user_id']] = row['vk_ids']
+
+
+def test_flush_writes_changed_sets():
+    index = MemoryIndex()
+    index.add(1, 100)
+    index.add(2, 200)
+    index.flush()
+    assert list(SeenSet.from_bytes(index.table[1]).ids) == [100]
+    assert list(SeenSet.from_bytes(index.table[2]).ids) == [200]
+    assert not index.dirty and not index.saving
+
+
+def test_evicted_set_is_visible_until_commit():
+    index = MemoryIndex()
+    index.add(1, 100)
+    seen = []
+
+    def evict_and_get():
+        # множество вытеснено из памяти, пока его запись ещё не закоммичена
+        index.sets = type(index.sets)(10, 60)
+        seen.append(list(index.get(1).ids))
+
+    index.during_upsert = evict_and_get
+    index.flush()
+    assert seen == [[100]]
+
+
+def test_failed_flush_keeps_sets_dirty():
+    index = MemoryIndex()
+    index.add(1, 100)
+
+    def fail():
+        raise RuntimeError('нет соединения')
+
+    index.during_upsert = fail
+    with pytest.raises(RuntimeError):
+        index.flush()
+    assert list(index.dirty) == [1]
+    index.during_upsert = None
+    index.flush()
+    assert 1 in index.table
@@ -0,0 +1,60 @@
+""" Тесты очереди запросов к API (vk_scheduler.VKScheduler): запросы диалогов обгоняют фоновые."""
+
+import threading
+import time
+
+from vk_scheduler import VKScheduler, INTERACTIVE, BACKGROUND
+
+RATE = 10
+
+
+def queue_request(scheduler, order, name, level):
+    def run():
+        with scheduler.priority(level):
+            scheduler.acquire('token', RATE)
+        order.append(name)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def wait_queued(scheduler, count):
+    deadline = time.monotonic() + 5
+    while len(scheduler.waiting.get('token', [])) < count:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_interactive_overtakes_background():
+    scheduler = VKScheduler()
+    order = []
+    scheduler.acquire('token', RATE)  # ведро пусто - следующие запросы ждут
+    threads = []
+    for number, (name, level) in enumerate([('bg1', BACKGROUND), ('bg2', BACKGROUND), ('dialog', INTERACTIVE)]):
+        threads.append(queue_request(scheduler, order, name, level))
+        wait_queued(scheduler, number + 1)
+    for thread in threads:
+        thread.join()
+    assert order == ['dialog', 'bg1', 'bg2']
+
+
+def test_promote_moves_waiting_request():
+    scheduler = VKScheduler()
+    order = []
+    scheduler.acquire('token', RATE)
+    background = queue_request(scheduler, order, 'bg', BACKGROUND)
+    wait_queued(scheduler, 1)
+    other = queue_request(scheduler, order, 'other', BACKGROUND)
+    wait_queued(scheduler, 2)
+    scheduler.promote(other)
+    background.join()
+    other.join()
+    assert order == ['other', 'bg']
+
+
+def test_priority_is_restored():
+    scheduler = VKScheduler()
+    with scheduler.priority(BACKGROUND):
+        assert scheduler.current_priority() == BACKGROUND
+    assert scheduler.current_priority() == INTERACTIVE
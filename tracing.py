@@ -0,0 +1,184 @@
+""" Модуль трассировки шагов диалога.
+
+    Каждое входящее событие открывает трассу. Вызовы API ВК, SQL-запросы, ожидание фото кандидатов
+    и отправка ответа внутри неё становятся вложенными отрезками со своим временем.
+    Трасса закрывается, когда обработан сам шаг и отправлены все его сообщения,
+    т.е. её длительность - это задержка, которую видит пользователь.
+    Шаги дольше config.trace_slow секунд печатаются с разбивкой по отрезкам:
+    по ней видно, что тормозило - фото, БД или лимит отправки сообщений."""
+
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Any, List, Optional, Tuple
+
+from sqlalchemy import event
+
+from config import config
+from metrics import metrics, statement_label
+
+# отрезок, внутри которого сейчас выполняется код: новые отрезки становятся его детьми
+_current: ContextVar = ContextVar('vkinder_span', default=None)
+
+
+class Span:
+    """Отрезок трассы"""
+
+    __slots__ = ('trace', 'name', 'depth', 'attrs', 'started', 'ended')
+
+    def __init__(self, trace: 'Trace', name: str, depth: int, attrs: Dict[str, Any], started: float = None):
+        self.trace = trace
+        self.name = name
+        self.depth = depth
+        self.attrs = attrs
+        self.started = time.monotonic() if started is None else started
+        self.ended = None
+
+    def end(self, ended: float = None) -> None:
+        self.ended = time.monotonic() if ended is None else ended
+
+
+class Trace:
+    """Трасса одного входящего события. pending - сколько частей (сам шаг и его сообщения) ещё не завершено"""
+
+    def __init__(self, name: str, threshold: float, attrs: Dict[str, Any]):
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.spans: List[Span] = []
+        self.pending = 1
+        self.root = self.start(name, 0, attrs)
+
+    def start(self, name: str, depth: int, attrs: Dict[str, Any], started: float = None) -> Span:
+        span = Span(self, name, depth, attrs, started)
+        with self.lock:
+            self.spans.append(span)
+        return span
+
+    def record(self, name: str, started: float, ended: float, **attrs) -> None:
+        """Отрезок, время которого измерено снаружи (например, ожидание в очереди исходящих)"""
+        self.start(name, 1, attrs, started).end(ended)
+
+    def hold(self) -> None:
+        with self.lock:
+            self.pending += 1
+
+    def release(self) -> None:
+        with self.lock:
+            self.pending -= 1
+            done = not self.pending
+        if done:
+            self.finish()
+
+    def finish(self) -> None:
+        ended = max(span.ended or span.started for span in self.spans)
+        total = ended - self.root.started
+        metrics.observe('dialog_step_seconds', total, state=self.root.attrs.get('state', ''))
+        if total >= self.threshold:
+            print(self.format(total))
+
+    def breakdown(self) -> Dict[str, float]:
+        """Суммарное время по видам отрезков верхнего уровня: vk, sql, photos, outbox"""
+        totals = defaultdict(float)
+        for span in self.spans:
+            if span.depth == 1 and span.ended is not None:
+                totals[span.name.split()[0]] += span.ended - span.started
+        return dict(totals)
+
+    def format(self, total: float) -> str:
+        attrs = ', '.join(f'{key}={value!r}' for key, value in self.root.attrs.items())
+        lines = [f'Медленный шаг {total * 1000:.0f} мс ({attrs})']
+        for span in sorted(self.spans, key=lambda span: span.started):
+            duration = f'{(span.ended - span.started) * 1000:7.0f}' if span.ended is not None else '      ?'
+            details = ', '.join(f'{key}={value}' for key, value in span.attrs.items()) if span.depth else ''
+            lines.append(f'  +{(span.started - self.root.started) * 1000:6.0f} мс {duration} мс  '
+                         f'{"  " * span.depth}{span.name}{f" ({details})" if details else ""}')
+        lines.append('  итого: ' + ', '.join(f'{name} {value * 1000:.0f} мс'
+                                             for name, value in sorted(self.breakdown().items())))
+        return '\n'.join(lines)
+
+
+@contextmanager
+def trace(name: str, **attrs):
+    """Трасса входящего события. При config.trace_slow = 0 трассировка выключена"""
+    if config.trace_slow <= 0:
+        yield None
+        return
+    new = Trace(name, config.trace_slow, attrs)
+    token = _current.set(new.root)
+    try:
+        yield new
+    finally:
+        new.root.end()
+        _current.reset(token)
+        new.release()
+
+
+def current_trace() -> Optional[Trace]:
+    parent = _current.get()
+    return parent.trace if parent else None
+
+
+def annotate(**attrs) -> None:
+    """Дополнение описания текущей трассы (например, состоянием диалога, известным только после разбора события)"""
+    parent = _current.get()
+    if parent:
+        parent.trace.root.attrs.update(attrs)
+
+
+def begin(name: str, **attrs) -> Optional[Tuple[Span, Any]]:
+    """Начало вложенного отрезка, если код выполняется внутри трассы. Завершается вызовом end"""
+    parent = _current.get()
+    if parent is None:
+        return None
+    child = parent.trace.start(name, parent.depth + 1, attrs)
+    return child, _current.set(child)
+
+
+def end(handle: Optional[Tuple[Span, Any]]) -> None:
+    if handle is None:
+        return
+    child, token = handle
+    child.end()
+    _current.reset(token)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """Вложенный отрезок текущей трассы; вне трассы ничего не делает"""
+    handle = begin(name, **attrs)
+    try:
+        yield handle[0] if handle else None
+    finally:
+        end(handle)
+
+
+@contextmanager
+def attach(trace: Optional[Trace]):
+    """Продолжение трассы в другом потоке: отрезки внутри блока записываются в неё"""
+    if trace is None:
+        yield
+        return
+    token = _current.set(trace.root)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def trace_engine(engine) -> None:
+    """Каждый SQL-запрос внутри трассы - отдельный отрезок"""
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('trace_spans', []).append(begin('sql ' + statement_label(statement)))
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        end(conn.info['trace_spans'].pop())
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        if context.connection is not None and context.connection.info.get('trace_spans'):
+            end(context.connection.info['trace_spans'].pop())
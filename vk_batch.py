@@ -0,0 +1,127 @@
+""" Модуль пакетных запросов к API ВК.
+
+    Вызовы методов, накопившиеся за короткий промежуток времени, объединяются в один запрос
+    execute (до 25 методов в одном), а результаты раздаются обратно вызывающим.
+    Так фото 25 кандидатов или users.get всех новых собеседников обходятся одним HTTP-запросом."""
+
+import json
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Dict, Any, List, Tuple
+
+import vk_api
+
+from metrics import metrics
+from vk_scheduler import scheduler, INTERACTIVE
+
+CALL = Tuple[str, Dict[str, Any]]
+
+
+class VKBatchError(Exception):
+    """Ошибка отдельного метода внутри execute"""
+
+    def __init__(self, method: str, error: Dict[str, Any] = None):
+        self.method = method
+        self.error = error or {}
+        super().__init__(f"{method}: [{self.error.get('error_code')}] {self.error.get('error_msg')}")
+
+
+def execute_code(calls: List[CALL]) -> str:
+    """Код VKScript, вызывающий переданные методы и возвращающий массив их результатов"""
+    api_calls = [f'API.{method}({json.dumps(values, ensure_ascii=False)})' for method, values in calls]
+    return f"return [{', '.join(api_calls)}];"
+
+
+def execute(vk_session: vk_api.VkApi, calls: List[CALL]) -> List[Any]:
+    """Синхронное выполнение списка вызовов пачками по 25 через execute.
+    На месте неудавшегося метода в результатах оказывается исключение VKBatchError."""
+    results = []
+    for start in range(0, len(calls), VKBatcher.MAX_CALLS):
+        chunk = calls[start:start + VKBatcher.MAX_CALLS]
+        response = vk_session.method('execute', values={'code': execute_code(chunk)}, raw=True)
+        errors = iter(response.get('execute_errors', []))
+        for (method, _), result in zip(chunk, response['response']):
+            # методы внутри execute считаем отдельно: в vk_api_calls_total они все - один execute
+            metrics.inc('vk_api_batched_calls_total', method=method)
+            if result is False:
+                result = VKBatchError(method, next(errors, None))
+                metrics.inc('vk_api_errors_total', method=method, code=result.error.get('error_code'))
+            results.append(result)
+    return results
+
+
+class VKBatcher:
+    """Сборщик вызовов API из разных потоков в запросы execute"""
+
+    MAX_CALLS = 25
+
+    def __init__(self, vk_session: vk_api.VkApi, delay: float = 0.05, priority: int = INTERACTIVE):
+        self.vk_session = vk_session
+        self.delay = delay
+        self.priority = priority
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.worker = None
+        # вызовы пакета, который выполняется сейчас, и те, чьего результата уже ждут диалоги
+        self.running = set()
+        self.urgent = set()
+
+    def call(self, method: str, values: Dict[str, Any] = None) -> Future:
+        """Постановка вызова в очередь. Результат будет доступен через future.result()"""
+        future = Future()
+        self._start()
+        self.queue.put((method, values or {}, future))
+        return future
+
+    def promote(self, future: Future) -> None:
+        """ Результата вызова уже ждёт диалог: пакет с ним выполняется с приоритетом INTERACTIVE,
+        даже если сам сборщик фоновый. Если пакет уже ждёт своей очереди в планировщике, он передвигается в ней."""
+        if future.done():
+            return
+        with self.lock:
+            self.urgent.add(future)
+            if future in self.running:
+                scheduler.promote(self.worker)
+
+    def _start(self) -> None:
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._run, name='vk-batcher', daemon=True)
+                self.worker.start()
+
+    def _collect(self) -> List[Tuple[str, Dict[str, Any], Future]]:
+        """Ожидание первого вызова и добор к нему тех, что успеют прийти за self.delay"""
+        batch = [self.queue.get()]
+        while len(batch) < self.MAX_CALLS:
+            try:
+                batch.append(self.queue.get(timeout=self.delay))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = [item for item in self._collect() if item[2].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                with scheduler.priority(self.priority):
+                    with self.lock:
+                        self.running = {future for *_, future in batch}
+                        if self.running & self.urgent:
+                            scheduler.promote(self.worker)
+                    results = execute(self.vk_session, [(method, values) for method, values, _ in batch])
+            except Exception as error:
+                for *_, future in batch:
+                    future.set_exception(error)
+                continue
+            finally:
+                with self.lock:
+                    self.urgent -= self.running
+                    self.running = set()
+            for (*_, future), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
@@ -0,0 +1,167 @@
+""" Модуль планировщика запросов к API ВК.
+
+    Каждый вызов API, откуда бы он ни шёл, получает разрешение у общего планировщика:
+    - на каждый токен доступа заведено своё "ведро токенов", пополняемое с разрешённой частотой,
+    - вызовы сверх лимита не падают с ошибкой "Too many requests per second", а ждут своей очереди,
+    - в очереди запросы диалогов с пользователями обгоняют фоновые (сбор гео-данных, подгрузку фото)."""
+
+import functools
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+import vk_api
+
+import tracing
+from metrics import metrics
+
+# приоритеты запросов: чем меньше, тем раньше
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class TokenBucket:
+    """Ведро токенов: rate разрешений в секунду, не более capacity накопленных"""
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Попытка взять токен. Возвращает 0 при успехе, иначе - сколько секунд ждать следующего"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class VKScheduler:
+    """Общая для всего процесса очередь запросов к API с учётом лимитов и приоритетов"""
+
+    def __init__(self):
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.waiting: Dict[str, List[List[int]]] = {}
+        self.cond = threading.Condition()
+        self.counter = itertools.count()
+        # приоритет каждого потока внутри блока priority() и запрос, которого поток ждёт сейчас
+        self.levels: Dict[int, int] = {}
+        self.entries: Dict[int, Tuple[str, List[int]]] = {}
+
+    @contextmanager
+    def priority(self, level: int):
+        """Все вызовы API внутри блока выполняются с указанным приоритетом"""
+        thread = threading.get_ident()
+        with self.cond:
+            previous = self.levels.get(thread)
+            self.levels[thread] = level
+        try:
+            yield
+        finally:
+            with self.cond:
+                if previous is None:
+                    del self.levels[thread]
+                else:
+                    self.levels[thread] = previous
+
+    def current_priority(self) -> int:
+        return self.levels.get(threading.get_ident(), INTERACTIVE)
+
+    def promote(self, thread: threading.Thread, level: int = INTERACTIVE) -> None:
+        """ Повышение приоритета вызовов, которые делает поток thread, до конца его текущего блока priority().
+        Запрос, который поток уже ждёт, передвигается в очереди сразу."""
+        with self.cond:
+            if self.levels.get(thread.ident, INTERACTIVE) <= level:
+                return
+            self.levels[thread.ident] = level
+            if thread.ident in self.entries:
+                key, entry = self.entries[thread.ident]
+                entry[0] = level
+                heapq.heapify(self.waiting[key])
+                self.cond.notify_all()
+
+    def acquire(self, key: str, rate: float) -> None:
+        """Ожидание разрешения на один запрос с токеном key"""
+        thread = threading.get_ident()
+        with self.cond:
+            entry = [self.current_priority(), next(self.counter)]
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(rate)
+            waiting = self.waiting.setdefault(key, [])
+            heapq.heappush(waiting, entry)
+            self.entries[thread] = (key, entry)
+            while True:
+                wait = None
+                if waiting[0] is entry:
+                    wait = bucket.take()
+                    if not wait:
+                        heapq.heappop(waiting)
+                        del self.entries[thread]
+                        self.cond.notify_all()
+                        return
+                self.cond.wait(wait)
+
+
+scheduler = VKScheduler()
+
+
+def background(func):
+    """Декоратор для фоновых задач: их запросы к API пропускают вперёд запросы диалогов"""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with scheduler.priority(BACKGROUND):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+class ScheduledVkApi(vk_api.VkApi):
+    """VkApi, все вызовы которого проходят через общий планировщик.
+    rate - разрешённое число запросов в секунду для токена (3 для пользователя, 20 для сообщества)."""
+
+    # собственная задержка vk_api между запросами больше не нужна - её заменяет ведро токенов
+    RPS_DELAY = 0
+
+    def __init__(self, *args, rate: float = 3, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate = rate
+
+    def copy(self) -> 'ScheduledVkApi':
+        """ Ещё одна сессия с тем же токеном. VkApi держит свою блокировку на всё время запроса,
+        поэтому одна сессия отправляет запросы строго по одному, а копии - параллельно.
+        Лимит у копий общий: ведро токенов планировщика привязано к токену, а не к сессии.
+        HTTP-адаптеры (пулы соединений, подмена адреса API в бенчмарках) копия берёт у исходной сессии."""
+        session = ScheduledVkApi(token=self.token['access_token'], api_version=self.api_version, rate=self.rate)
+        for prefix, adapter in self.http.adapters.items():
+            session.http.mount(prefix, adapter)
+        return session
+
+    def method(self, method, values=None, *args, **kwargs):
+        key = (self.token or {}).get('access_token') or str(id(self))
+        with tracing.span('vk ' + method) as span:
+            started = time.monotonic()
+            scheduler.acquire(key, self.rate)
+            sent = time.monotonic()
+            metrics.observe('vk_api_wait_seconds', sent - started, method=method)
+            if span:
+                span.attrs['ожидание'] = f'{(sent - started) * 1000:.0f} мс'
+            try:
+                return super().method(method, values, *args, **kwargs)
+            except vk_api.ApiError as error:
+                metrics.inc('vk_api_errors_total', method=method, code=error.code)
+                raise
+            except Exception as error:
+                metrics.inc('vk_api_errors_total', method=method, code=type(error).__name__)
+                raise
+            finally:
+                metrics.inc('vk_api_calls_total', method=method)
+                metrics.observe('vk_api_latency_seconds', time.monotonic() - sent, method=method)
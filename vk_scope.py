@@ -5,115 +5,159 @@
     - обработку результатов поиска.
 
     Дополнительно модуль имеет отдельный класс "VKGeoData" для сбора информации из базы данных ВК
-    для её последующей записи в собственную БД программы. Нашел в просторах Гитхаба)"""
+    для её последующей записи в собственную БД программы. Нашел в просторах Гитхаба)
+    Полное обновление гео-данных удобнее делать через "VKGeoCrawler": python vk_scope.py --crawl"""
 
 import json
 import operator
-import os
-from typing import List, Dict, Any
+import sys
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from datetime import datetime
+from typing import List, Dict, Any, Tuple
 
 import vk_api
-from ratelimit import limits
 from tqdm import tqdm
 
+from config import config, lazy
 from database import Connect, User
+from vk_batch import VKBatcher, execute
+from vk_scheduler import ScheduledVkApi, background, BACKGROUND
 
 LIST_OF_DICTS = List[Dict[str, Any]]
 
 
-class VKAuth:
-    # Введите токен пользователя
-    TOKEN = 'HERE'
-    if TOKEN:
-        vk_session = vk_api.VkApi(token=TOKEN)
+def _user_session() -> ScheduledVkApi:
+    """Сессия API от имени пользователя: по токену, а без него - по логину и паролю"""
+    if config.user_token:
+        vk_session = ScheduledVkApi(token=config.user_token)
     else:
-        username: str = os.getenv("VK_USER_LOGIN")
-        password: str = os.getenv("VK_USER_PASS")
+        username = config.user_login
+        password = config.user_password
         scope = 'users,notify,friends,photos,status,notifications,offline,wall,audio,video'
         if not username or not password:
             username: str = input("Укажите свой логин: ")
             password: str = input("Укажите свой пароль: ")
-        vk_session = vk_api.VkApi(username, password, scope=scope, api_version='5.124')
-
+        vk_session = ScheduledVkApi(username, password, scope=scope, api_version=config.api_version)
 
     try:
         vk_session.auth(token_only=True)
     except vk_api.AuthError as error_msg:
         print(error_msg)
+    return vk_session
+
+
+class VKAuth:
+    # у самого класса авторизации нет полей экземпляра - наследники могут обходиться без __dict__
+    __slots__ = ()
+
+    # авторизация (и, возможно, запрос логина) происходит при первом запросе к API, а не при импорте модуля
+    vk_session = lazy(_user_session)
+
+    # общий сборщик вызовов API в пакетные запросы execute (пока он нужен только для подгрузки фото)
+    @lazy
+    def batcher():
+        return VKBatcher(VKAuth.vk_session, priority=BACKGROUND)
+
 
 class VKGeoData(VKAuth):
     """ Класс со служебными методами для сбора информации для БД """
 
-    REQUESTS_PER = 3
-    SECOND = 1
-
+    FIXTURES = '../DB/Fixtures/'
+    PAGE_SIZE = 1000
+
+    # первые два региона ВК не отдаёт: это города федерального значения
+    SEED_REGIONS = [{'model': 'region', 'fields': {"id": 1, "title": "Москва город", "country_id": 1}},
+                    {'model': 'region', 'fields': {"id": 2, "title": "Санкт-Петербург город", "country_id": 1}}]
+
+    def _fetch_all(self, method: str, values_list: LIST_OF_DICTS) -> List[LIST_OF_DICTS or Exception]:
+        """ Постраничный сбор всех элементов для нескольких запросов сразу.
+        Первые страницы всех запросов идут через execute по 25 в одном: большинству стран и регионов
+        больше одной страницы и не нужно. Остальные страницы (их количество берём из ответа на первую)
+        дочитываются по одной. На месте запроса, который не удался, оказывается исключение."""
+        calls = [(method, {**values, 'count': self.PAGE_SIZE, 'offset': 0}) for values in values_list]
+        results = []
+        for (_, values), response in zip(calls, execute(self.vk_session, calls)):
+            if isinstance(response, Exception):
+                results.append(response)
+                continue
+            items = response['items']
+            try:
+                for offset in range(self.PAGE_SIZE, response['count'], self.PAGE_SIZE):
+                    items.extend(self.vk_session.method(method, values={**values, 'offset': offset})['items'])
+            except Exception as error:
+                items = error
+            results.append(items)
+        return results
+
+    @staticmethod
+    def _groups(parts: list) -> List[list]:
+        """Части по 25 - столько первых страниц помещается в один execute"""
+        return [parts[start:start + VKBatcher.MAX_CALLS] for start in range(0, len(parts), VKBatcher.MAX_CALLS)]
+
+    def _regions_of(self, countries: LIST_OF_DICTS) -> List[LIST_OF_DICTS or Exception]:
+        """Все регионы каждой из стран"""
+        ids = [country['fields']['id'] for country in countries]
+        results = self._fetch_all('database.getRegions', [{'country_id': country_id} for country_id in ids])
+        return [regions if isinstance(regions, Exception) else
+                [{'model': 'region', 'fields': {**region, 'country_id': country_id}} for region in regions]
+                for country_id, regions in zip(ids, results)]
+
+    def _cities_of(self, regions: LIST_OF_DICTS) -> List[LIST_OF_DICTS or Exception]:
+        """Все города каждого из регионов"""
+        ids = [region['fields']['id'] for region in regions]
+        results = self._fetch_all('database.getCities', [
+            {'country_id': region['fields']['country_id'], 'region_id': region['fields']['id'], 'need_all': 1}
+            for region in regions])
+        return [cities if isinstance(cities, Exception) else
+                [{'model': 'city', 'fields': {**city, 'region_id': region_id}} for city in cities]
+                for region_id, cities in zip(ids, results)]
+
+    def _load_fixture(self, name: str) -> LIST_OF_DICTS:
+        with open(self.FIXTURES + name, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _dump_fixture(self, name: str, data: LIST_OF_DICTS) -> None:
+        with open(self.FIXTURES + name, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+
+    def _countries(self) -> LIST_OF_DICTS:
+        """Все страны"""
+        countries = self.vk_session.method('database.getCountries', values={'need_all': 1, 'count': 1000})['items']
+        return [{'model': 'country', 'fields': country} for country in countries]
+
+    @background
     def get_countries(self) -> LIST_OF_DICTS:
         """Служебный метод для сбора всех стран.
         Используется для заполнения БД."""
 
         print('Страны')
-        countries = []
-        countries_query = self.vk_session.method('database.getCountries',
-                                                 values={'need_all': 1, 'count': 1000})['items']
-
-        for country in countries_query:
-            new_dic = {'model': 'country', 'fields': country}
-            countries.append(new_dic)
-
-        with open('../DB/Fixtures/countries.json', 'w', encoding='utf-8') as f:
-            json.dump(countries, f)
-        return countries_query
+        countries = self._countries()
+        self._dump_fixture('countries.json', countries)
+        return countries
 
-    @limits(REQUESTS_PER, SECOND)
+    @background
     def get_regions(self, countries: LIST_OF_DICTS = None) -> LIST_OF_DICTS:
         """Служебный метод для сбора всех регионов во всех странах.
         Используется для заполнения БД."""
 
         print('Регионы')
-        regions = [{'model': 'region', 'fields': {"id": 1, "title": "Москва город", "country_id": 1}},
-                   {'model': 'region', 'fields': {"id": 2, "title": "Санкт-Петербург город", "country_id": 1}}]
+        regions = list(self.SEED_REGIONS)
 
         if not countries:
             try:
-                with open('../DB/Fixtures/countries.json', 'r', encoding='utf-8') as f:
-                    countries = json.load(f)
+                countries = self._load_fixture('countries.json')
             except (FileNotFoundError, FileExistsError):
                 countries = self.get_countries()
-        for country in countries:
-            print(".", end='')
-
-            regions_quantity = \
-                self.vk_session.method('database.getRegions', values={'country_id': country['fields']['id'],
-                                                                      'count': 100})['count']
-
-            if regions_quantity:
-                search_values = {'country_id': country['fields']['id'], 'count': 100}
-                regions_quantity = self.vk_session.method('database.getRegions', values=search_values)['count']
-                if regions_quantity > 100:
-                    queries = regions_quantity // 100 + 1
-                    values = {'country_id': country['fields']['id'], 'count': 100, 'offset': 0}
-                    for query in tqdm(range(queries), desc=f"Обходим регионы в стране {country['fields']['title']}"):
-                        values['offset'] = 100 * query
-                        regions_list = self.vk_session.method('database.getRegions', values=values)['items']
-                        if regions_list:
-                            for region in regions_list:
-                                region.update({'country_id': country['fields']['id']})
-                                new_dic = {'model': 'region', 'fields': region}
-                                regions.append(new_dic)
-
-                    else:
-                        regions_list = self.vk_session.method('database.getRegions', values=search_values)['items']
-                        if regions_list:
-                            for region in regions_list:
-                                region.update({'country_id': country['fields']['id']})
-                                new_dic = {'model': 'region', 'fields': region}
-                                regions.append(new_dic)
-
-        with open('../DB/Fixtures/regions.json', 'w', encoding='utf-8') as f:
-            json.dump(regions, f)
+        for group in tqdm(self._groups(countries), desc="Обходим страны"):
+            for rows in self._regions_of(group):
+                if isinstance(rows, Exception):
+                    raise rows
+                regions.extend(rows)
+
+        self._dump_fixture('regions.json', regions)
         return regions
 
-    @limits(REQUESTS_PER, SECOND)
+    @background
     def get_cities(self, regions: LIST_OF_DICTS = None) -> LIST_OF_DICTS:
         """Служебный метод для сбора всех городов во всех странах.
         Используется для заполнения БД."""
@@ -123,69 +167,137 @@ class VKGeoData(VKAuth):
 
         if not regions:
             try:
-                with open('../DB/Fixtures/regions.json', 'r', encoding='utf-8') as f:
-                    regions = json.load(f)
+                regions = self._load_fixture('regions.json')
             except (FileNotFoundError, FileExistsError):
                 regions = self.get_regions()
-        for region in regions:
-            print(".", end='')
-
-            search_values = {'country_id': region['fields']['country_id'], 'region_id': region['fields']['id'],
-                             'need_all': 1, 'count ': 100}
-            cities_quantity = self.vk_session.method('database.getCities', values=search_values)['count']
-
-            if cities_quantity:
-                if cities_quantity > 100:
-                    queries = cities_quantity // 100 + 1
-                    values = {'country_id': region['fields']['country_id'], 'region_id': region['fields']['id'],
-                              'offset': 0, 'need_all': 1, 'count ': 100}
-                    for query in tqdm(range(queries), desc=f"Обходим города в регионе {region['fields']['title']}"):
-
-                        values['offset'] = 100 * query
-                        cities_list = self.vk_session.method('database.getCities', values=values)['items']
-                        if cities_list:
-                            for city in cities_list:
-                                city.update({'region_id': region['fields']['id']})
-                                new_dic = {'model': 'city', 'fields': city}
-                                cities.append(new_dic)
-
-                else:
-                    cities_list = self.vk_session.method('database.getCities', values=search_values)['items']
-                    if cities_list:
-                        for city in cities_list:
-                            city.update({'region_id': region['fields']['id']})
-                            new_dic = {'model': 'city', 'fields': city}
-                            cities.append(new_dic)
-
-        with open('../DB/Fixtures/cities.json', 'w', encoding='utf-8') as f:
-            json.dump(cities, f)
+        for group in tqdm(self._groups(regions), desc="Обходим регионы"):
+            for rows in self._cities_of(group):
+                if isinstance(rows, Exception):
+                    raise rows
+                cities.extend(rows)
+
+        self._dump_fixture('cities.json', cities)
         return cities
 
+
+class VKGeoCrawler(VKGeoData):
+    """ Режим сбора гео-данных для полного обновления БД:
+    - страны и регионы обходятся параллельно в пределах лимита запросов,
+    - результаты сразу дописываются в файлы JSONL,
+    - обработанные страны и регионы отмечаются в файле прогресса, и перезапущенный сбор продолжается с места остановки.
+    """
+
+    WORKERS = 4
+
+    def _crawl(self, name: str, partitions: Dict[str, Dict[str, Any]], fetch) -> None:
+        """ Параллельный обход частей (стран или регионов) с потоковой записью результатов и сохранением прогресса.
+        Части обходятся группами по 25: fetch получает группу и возвращает строки (или исключение) для каждой части."""
+        data_path = f'{self.FIXTURES}{name}.jsonl'
+        progress_path = f'{self.FIXTURES}{name}.progress'
+        try:
+            with open(progress_path, 'r', encoding='utf-8') as f:
+                done = set(f.read().split())
+        except FileNotFoundError:
+            done = set()
+        todo = {key: part for key, part in partitions.items() if key not in done}
+        if done:
+            print(f'{name}: продолжаем сбор, осталось {len(todo)} из {len(partitions)}')
+
+        with open(data_path, 'a', encoding='utf-8') as data, open(progress_path, 'a', encoding='utf-8') as progress, \
+                ThreadPoolExecutor(max_workers=self.WORKERS, thread_name_prefix=f'geo-{name}') as executor:
+            futures = {executor.submit(background(fetch), [todo[key] for key in group]): group
+                       for group in self._groups(list(todo))}
+            for future in tqdm(as_completed(futures), total=len(futures), desc=f'Собираем {name}'):
+                group = futures[future]
+                try:
+                    results = future.result()
+                except Exception as error:
+                    results = [error] * len(group)
+                for key, rows in zip(group, results):
+                    if isinstance(rows, Exception):
+                        # часть не отмечена как обработанная - её заберёт следующий запуск
+                        print(f'{name}: ошибка при обходе {key}: {rows!r}')
+                        continue
+                    for row in rows:
+                        data.write(json.dumps(row, ensure_ascii=False) + '\n')
+                    data.flush()
+                    # отметку о прогрессе ставим только после записи данных:
+                    # при сбое между ними часть просто соберётся повторно, а дубли перезапишутся при загрузке в БД
+                    progress.write(key + '\n')
+                    progress.flush()
+
+    def _read_jsonl(self, name: str) -> LIST_OF_DICTS:
+        with open(f'{self.FIXTURES}{name}.jsonl', 'r', encoding='utf-8') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def crawl_countries(self) -> None:
+        self._crawl('countries', {'all': None}, lambda _: [self._countries()])
+
+    def crawl_regions(self) -> None:
+        try:
+            countries = self._read_jsonl('countries')
+        except FileNotFoundError:
+            self.crawl_countries()
+            countries = self._read_jsonl('countries')
+        partitions = {'seed': None, **{str(country['fields']['id']): country for country in countries}}
+        self._crawl('regions', partitions, self._regions_with_seed)
+
+    def _regions_with_seed(self, countries: List[Dict[str, Any] or None]) -> List[LIST_OF_DICTS or Exception]:
+        """Регионы группы стран; вместо части без страны - регионы, которые ВК не отдаёт"""
+        found = iter(self._regions_of([country for country in countries if country]))
+        return [next(found) if country else self.SEED_REGIONS for country in countries]
+
+    def crawl_cities(self) -> None:
+        try:
+            regions = self._read_jsonl('regions')
+        except FileNotFoundError:
+            self.crawl_regions()
+            regions = self._read_jsonl('regions')
+        self._crawl('cities', {str(region['fields']['id']): region for region in regions}, self._cities_of)
+
+
 class VKUser(VKAuth, Connect):
     """Класс пользователя ВК, общающегося с ботом"""
 
-    def __init__(self, id: int):
+    __slots__ = ('user_id', 'first_name', 'last_name', 'sex', 'link', 'welcomed', 'city', 'country')
+
+    # поля users.get, нужные для профиля
+    FIELDS = 'city, country, sex, domain, home_town'
+
+    def __init__(self, id: int, info: Dict[str, Any] = None):
         self.user_id = id
-        info = self.get_self_info(self.user_id)
-        self.first_name = info[0].get('first_name')
-        self.last_name = info[0].get('last_name')
-        self.sex = info[0].get('sex')
-        self.link = 'https://vk.com/' + str(info[0].get('domain'))
+        if info is None:
+            info = self.get_self_info(self.user_id)[0]
+        self.first_name = info.get('first_name')
+        self.last_name = info.get('last_name')
+        self.sex = info.get('sex')
+        self.link = 'https://vk.com/' + str(info.get('domain'))
         self.welcomed = False
 
         # Если город и страна пользователя не указаны - Москва по умолчанию
-        if not info[0].get('city'):
+        if not info.get('city'):
             self.city = {'id': 1, 'title': 'Москва'}
             self.country = {'id': 1, 'title': 'Россия'}
         else:
-            self.city = info[0].get('city')
-            self.country = info[0].get('country')
+            self.city = info.get('city')
+            self.country = info.get('country')
+
+    @classmethod
+    def get_many(cls, ids: List[int]) -> Dict[int, 'VKUser']:
+        """Профили нескольких пользователей одним вызовом users.get"""
+        if not ids:
+            return {}
+        search_values = {
+            'user_ids': ','.join(str(user_id) for user_id in ids),
+            'fields': cls.FIELDS
+        }
+        return {info['id']: cls(info['id'], info) for info in cls.vk_session.method('users.get', values=search_values)}
 
     def get_self_info(self, user_id: int) -> LIST_OF_DICTS:
         """Метод получения всей необходимой информации о пользователе"""
         search_values = {
             'user_id': user_id,
-            'fields': 'city, country, sex, domain, home_town'
+            'fields': self.FIELDS
         }
         return self.vk_session.method('users.get', values=search_values)
 
@@ -208,21 +320,29 @@ class VKUser(VKAuth, Connect):
 class VKDatingUser(VKAuth):
     """Класс юзера ВК, найденного по запросу пользователя"""
 
+    # таких объектов в очередях просмотра много - храним их компактно
+    __slots__ = ('db_id', 'id', 'first_name', 'last_name', 'link', 'photos')
+
     def __init__(self, db_id: int, vk_id: int, first_name: str, last_name: str, vk_link: str):
         self.db_id = db_id
         self.id = vk_id
         self.first_name = first_name
         self.last_name = last_name
         self.link = vk_link
+        self.photos = []
 
     def __str__(self):
         return self.first_name + ' ' + self.last_name + ' ' + self.link
 
-    def get_photo(self):
-        """Метод получения топ-3 фото юзера"""
+    def request_photo(self) -> Future:
+        """Запрос фото юзера через общий сборщик, без ожидания ответа"""
         search_values = {'owner_id': self.id, 'album_id': 'profile', 'count': 1000, 'extended': 1,
                          'photo_sizes': 1, 'type': 'm'}
-        response = self.vk_session.method('photos.get', values=search_values)
+        return self.batcher.call('photos.get', values=search_values)
+
+    @staticmethod
+    def top_photos(response: Dict[str, Any]) -> List[Tuple[int, int]]:
+        """Топ-3 фото по лайкам из ответа photos.get"""
         photos = []
         for photo in response['items']:
             photos.append((photo['id'], photo['owner_id'], photo['likes']['count']))
@@ -232,10 +352,16 @@ class VKDatingUser(VKAuth):
 
 
 if __name__ == '__main__':
-    geo = VKGeoData()
     now = datetime.now()
     print(now)
-    geo.get_countries()
-    geo.get_regions()
-    geo.get_cities()
+    if '--crawl' in sys.argv:
+        crawler = VKGeoCrawler()
+        crawler.crawl_countries()
+        crawler.crawl_regions()
+        crawler.crawl_cities()
+    else:
+        geo = VKGeoData()
+        geo.get_countries()
+        geo.get_regions()
+        geo.get_cities()
     print(datetime.now() - now)